@@ -1,29 +1,30 @@
-from fastapi import FastAPI, HTTPException, Cookie, Request, Query
+import time
+
+# Recorded before the heavier imports so the startup report covers them
+_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Cookie, Request, Query, WebSocket, WebSocketDisconnect
+from starlette.requests import HTTPConnection
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
 from pydantic import BaseModel
-import uvicorn
+from contextlib import asynccontextmanager, aclosing
 import httpx
-import subprocess
 import json
 import asyncio
 import os
 import sqlite3
 import uuid
-import stripe
+import math
+import re
+import ipaddress
+import random
+import sys
+import threading
+import traceback
+from collections import OrderedDict, deque
 from typing import Optional
 
-app = FastAPI(title="Local AI Studio Backend")
-
-# CORS for frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Ollama configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 
@@ -35,27 +36,65 @@ STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY", "")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 
-# Initialize Stripe
-if STRIPE_SECRET_KEY and not STRIPE_SECRET_KEY.startswith("PLACEHOLDER"):
-    stripe.api_key = STRIPE_SECRET_KEY
+# Stripe SDK is heavy to import and only needed for purchases,
+# so it is loaded on first use instead of at startup
+_stripe = None
+
+def get_stripe():
+    """Import and configure the Stripe SDK on first use"""
+    global _stripe
+    if _stripe is None:
+        import stripe
+        if STRIPE_SECRET_KEY and not STRIPE_SECRET_KEY.startswith("PLACEHOLDER"):
+            stripe.api_key = STRIPE_SECRET_KEY
+        _stripe = stripe
+    return _stripe
 
 # Gumroad configuration for instant monetization
+GUMROAD_API_BASE = os.getenv("GUMROAD_API_BASE", "https://api.gumroad.com").rstrip("/")
 try:
     GUMROAD_API_KEY = os.getenv("GUMROAD_API_KEY", "").strip().strip('"').strip("'")
     GUMROAD_PRODUCT_PERMALINK = os.getenv("GUMROAD_PRODUCT_PERMALINK", "udody").strip().strip('"').strip("'")
+    _CONFIG_ERROR = None
+except Exception as e:
+    _CONFIG_ERROR = e
+    GUMROAD_API_KEY = ""
+    GUMROAD_PRODUCT_PERMALINK = "udody"
 
-    # Print config on startup for debugging
+def log_config():
+    """Print configuration once per process (called from lifespan startup)"""
+    if _CONFIG_ERROR:
+        print(f"[CONFIG] ERROR loading Gumroad config: {_CONFIG_ERROR}")
+        return
     print(f"[CONFIG] Gumroad Key Raw: '{os.getenv('GUMROAD_API_KEY', '')}'")
     print(f"[CONFIG] Gumroad Key Configured: {'Yes' if GUMROAD_API_KEY else 'No'}")
     print(f"[CONFIG] Gumroad Permalink: {GUMROAD_PRODUCT_PERMALINK}")
-except Exception as e:
-    print(f"[CONFIG] ERROR loading Gumroad config: {e}")
-    GUMROAD_API_KEY = ""
-    GUMROAD_PRODUCT_PERMALINK = "udody"
 
 # License key cache (upgrade to DB later if needed)
 VALID_LICENSES = set()
 
+# Keys Gumroad rejected recently -> monotonic expiry. The marketplace polls
+# with the stored key, so without this a refunded key would hit Gumroad (and
+# the license rate limit) on every poll.
+INVALID_LICENSES = {}
+INVALID_LICENSE_TTL_SECONDS = float(os.getenv("INVALID_LICENSE_TTL_SECONDS", "300"))
+
+def remember_invalid_license(license_key: str):
+    now = time.monotonic()
+    if len(INVALID_LICENSES) >= 10000:
+        for key in [k for k, expires in INVALID_LICENSES.items() if expires < now]:
+            del INVALID_LICENSES[key]
+    INVALID_LICENSES[license_key] = now + INVALID_LICENSE_TTL_SECONDS
+
+def known_invalid_license(license_key: str) -> bool:
+    expires = INVALID_LICENSES.get(license_key)
+    if expires is None:
+        return False
+    if expires < time.monotonic():
+        del INVALID_LICENSES[license_key]
+        return False
+    return True
+
 # Free tier models (3 models)
 FREE_MODELS = ["tinyllama:latest", "llama3.2:3b", "gemma2:2b"]
 
@@ -84,28 +123,154 @@ MODEL_PRICES = {
     "mistral:7b-instruct-v0.3": 0.99,
 }
 
+# Tokenizer family of each Ollama model, plus its context window (num_ctx)
+# where one is configured. Without one a model runs with DEFAULT_CONTEXT -
+# the 2048 Ollama uses anyway. Larger windows multiply KV-cache memory and
+# prompt evaluation time, so they are opt-in per model.
+MODEL_REGISTRY = {
+    "tinyllama:latest": {"family": "llama"},
+    "llama3.2:3b": {"family": "llama3"},
+    "llama3.1:8b": {"family": "llama3"},
+    "gemma2:2b": {"family": "gemma"},
+    "gemma2:9b": {"family": "gemma"},
+    "phi3.5:mini": {"family": "phi3"},
+    "phi3:medium": {"family": "phi3"},
+    "qwen2.5:7b": {"family": "qwen"},
+    "codellama:7b": {"family": "llama"},
+    "mistral:7b-instruct": {"family": "mistral"},
+    "mistral:7b-instruct-v0.3": {"family": "mistral"},
+    "deepseek-coder:6.7b": {"family": "deepseek"},
+}
+# e.g. MODEL_CONTEXT_JSON='{"llama3.1:8b": 8192}'
+for _model, _context in json.loads(os.getenv("MODEL_CONTEXT_JSON", "{}")).items():
+    MODEL_REGISTRY.setdefault(_model, {"family": "default"})["context"] = int(_context)
+
 # Database path - use mounted volume for persistence
-DB_PATH = os.path.join('/app/data', 'purchases.db')
+# (DATA_DIR can be overridden for local runs and benchmarks)
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
+DB_PATH = os.path.join(DATA_DIR, 'purchases.db')
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have already run, so each one is applied exactly once per database file.
+MIGRATIONS = [
+    '''CREATE TABLE IF NOT EXISTS purchases
+       (user_id TEXT NOT NULL,
+        model_id TEXT NOT NULL,
+        purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        stripe_session_id TEXT,
+        PRIMARY KEY (user_id, model_id))''',
+    # Single-row table the readiness probe writes to, proving the volume is writable
+    '''CREATE TABLE IF NOT EXISTS readiness_probe
+       (id INTEGER PRIMARY KEY CHECK (id = 1),
+        checked_at TIMESTAMP)''',
+    # Usage accounting: raw events (kept USAGE_RAW_RETENTION_DAYS) plus
+    # hourly/daily rollups that answer capacity questions over months
+    '''CREATE TABLE IF NOT EXISTS usage_events
+       (ts REAL NOT NULL,
+        client TEXT NOT NULL,
+        model TEXT NOT NULL,
+        ollama_model TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        eval_tokens INTEGER NOT NULL,
+        total_duration_ms REAL NOT NULL,
+        load_duration_ms REAL NOT NULL,
+        prompt_eval_duration_ms REAL NOT NULL,
+        eval_duration_ms REAL NOT NULL,
+        cache_hit INTEGER NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS usage_events_ts ON usage_events (ts)''',
+    '''CREATE TABLE IF NOT EXISTS usage_hourly
+       (bucket INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        ollama_model TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        requests INTEGER NOT NULL,
+        cache_hits INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        eval_tokens INTEGER NOT NULL,
+        total_duration_ms REAL NOT NULL,
+        PRIMARY KEY (bucket, model, ollama_model, tier)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS usage_daily
+       (bucket INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        ollama_model TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        requests INTEGER NOT NULL,
+        cache_hits INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        eval_tokens INTEGER NOT NULL,
+        total_duration_ms REAL NOT NULL,
+        PRIMARY KEY (bucket, model, ollama_model, tier)) WITHOUT ROWID''',
+]
 
-# Initialize SQLite database for purchases
 def init_db():
-    """Create purchases database if it doesn't exist"""
+    """Create the purchases database and apply pending migrations"""
     # Ensure data directory exists
-    os.makedirs('/app/data', exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS purchases
-                 (user_id TEXT NOT NULL,
-                  model_id TEXT NOT NULL,
-                  purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  stripe_session_id TEXT,
-                  PRIMARY KEY (user_id, model_id))''')
-    conn.commit()
-    conn.close()
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    try:
+        # Take the write lock first so concurrent uvicorn workers
+        # don't race each other through the same migration
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for statement in MIGRATIONS[version:]:
+            conn.execute(statement)
+        if version < len(MIGRATIONS):
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return version
+
+# Startup timings (seconds), reported once the lifespan has finished
+STARTUP_TIMES = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Process startup/shutdown - runs once per uvicorn worker"""
+    log_config()
+    schema_version = init_db()
+    if schema_version < len(MIGRATIONS):
+        print(f"[STARTUP] Database migrated: v{schema_version} -> v{len(MIGRATIONS)}")
+
+    global OLLAMA_CLIENT
+    OLLAMA_CLIENT = httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=5.0))
+
+    background_tasks = [
+        asyncio.create_task(readiness_loop()),
+        asyncio.create_task(usage_flush_loop()),
+    ]
+    if DIAGNOSTICS_MODE:
+        background_tasks.append(start_lag_monitor())
+
+    STARTUP_TIMES["ready"] = time.perf_counter() - _IMPORT_STARTED
+    print(f"[STARTUP] Module import: {STARTUP_TIMES['import'] * 1000:.0f}ms, "
+          f"ready: {STARTUP_TIMES['ready'] * 1000:.0f}ms")
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    # Don't lose buffered usage records on restart
+    await flush_usage()
+    if _semantic_cache is not None:
+        _semantic_cache.save()
+    await OLLAMA_CLIENT.aclose()
+
+app = FastAPI(title="Local AI Studio Backend", lifespan=lifespan)
 
-# Initialize database on startup
-init_db()
+# CORS for frontend
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 class ChatRequest(BaseModel):
     message: str
@@ -123,73 +288,1704 @@ async def health():
     """Health check endpoint"""
     return {"status": "healthy", "service": "Local AI Studio Backend"}
 
+# ==================== READINESS ====================
+
+# How often the background task refreshes the readiness snapshot
+READINESS_REFRESH_SECONDS = float(os.getenv("READINESS_REFRESH_SECONDS", "5"))
+
+# Chat requests allowed in flight (waiting on or running in Ollama)
+# before new ones are shed with a 503
+MAX_CHAT_QUEUE_DEPTH = int(os.getenv("MAX_CHAT_QUEUE_DEPTH", "16"))
+
+# Number of /api/chat requests currently in flight
+CHAT_IN_FLIGHT = 0
+
+# One connection pool per worker for every call to Ollama, created in lifespan().
+# Building an AsyncClient loads the CA bundle synchronously (30-50ms with the
+# event loop blocked), so it must not happen per probe or per request.
+OLLAMA_CLIENT = None
+
+# Last known upstream state, refreshed in the background so probes
+# from Docker and nginx never trigger an Ollama round-trip themselves
+READINESS = {
+    "ollama_reachable": False,
+    "installed_models": [],
+    "loaded_models": [],
+    "db_writable": False,
+    "checked_at": 0.0,
+    "errors": {},
+    # Bumped whenever installed_models changes - the /api/models ETag
+    "tags_generation": 0,
+}
+
+def check_db_writable() -> bool:
+    """Write the probe row - fails if the SQLite volume is read-only or full"""
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    try:
+        conn.execute("INSERT OR REPLACE INTO readiness_probe (id, checked_at) VALUES (1, CURRENT_TIMESTAMP)")
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+async def refresh_readiness():
+    """Probe Ollama and the database once and replace the snapshot"""
+    snapshot = {
+        "ollama_reachable": False,
+        "installed_models": [],
+        "loaded_models": [],
+        "db_writable": False,
+        "errors": {},
+    }
+
+    try:
+        tags, ps = await asyncio.gather(
+            OLLAMA_CLIENT.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=3.0),
+            OLLAMA_CLIENT.get(f"{OLLAMA_BASE_URL}/api/ps", timeout=3.0),
+        )
+        tags.raise_for_status()
+        snapshot["ollama_reachable"] = True
+        snapshot["installed_models"] = [m['name'] for m in tags.json().get('models', [])]
+        # /api/ps lists models currently loaded into memory (older Ollama lacks it)
+        if ps.status_code == 200:
+            snapshot["loaded_models"] = [m['name'] for m in ps.json().get('models', [])]
+    except Exception as e:
+        snapshot["errors"]["ollama"] = f"{type(e).__name__}: {e}"
+
+    try:
+        snapshot["db_writable"] = await asyncio.to_thread(check_db_writable)
+    except Exception as e:
+        snapshot["errors"]["db"] = f"{type(e).__name__}: {e}"
+
+    snapshot["checked_at"] = time.time()
+    snapshot["tags_generation"] = READINESS["tags_generation"] + (
+        snapshot["installed_models"] != READINESS["installed_models"]
+    )
+    READINESS.update(snapshot)
+
+async def readiness_loop():
+    """Background task started by lifespan()"""
+    while True:
+        try:
+            await refresh_readiness()
+        except Exception as e:
+            print(f"[READINESS] Refresh failed: {type(e).__name__}: {e}")
+        await asyncio.sleep(READINESS_REFRESH_SECONDS)
+
+def readiness_fresh() -> bool:
+    """True if the snapshot is recent enough to base decisions on"""
+    return time.time() - READINESS["checked_at"] < READINESS_REFRESH_SECONDS * 3
+
+@app.get("/api/ready")
+async def ready():
+    """
+    Readiness check - served from the background snapshot, never calls upstream
+    Returns 503 while Ollama is unreachable or the database is not writable
+    """
+    fresh = readiness_fresh()
+    is_ready = fresh and READINESS["ollama_reachable"] and READINESS["db_writable"]
+    return JSONResponse({
+        "ready": is_ready,
+        "ollama_reachable": READINESS["ollama_reachable"],
+        "installed_models": READINESS["installed_models"],
+        "loaded_models": READINESS["loaded_models"],
+        "db_writable": READINESS["db_writable"],
+        "queue_depth": CHAT_IN_FLIGHT,
+        "max_queue_depth": MAX_CHAT_QUEUE_DEPTH,
+        "breakers": {name: b.state for name, b in BREAKERS.items()},
+        "snapshot_age_s": round(time.time() - READINESS["checked_at"], 2) if READINESS["checked_at"] else None,
+        "errors": READINESS["errors"],
+    }, status_code=200 if is_ready else 503)
+
+# ==================== METRICS ====================
+
+# Prometheus-style counters and gauges: (name, sorted label items) -> value
+METRICS = {}
+
+def inc_metric(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    METRICS[key] = METRICS.get(key, 0) + value
+
+def set_metric(name: str, value: float, **labels):
+    METRICS[(name, tuple(sorted(labels.items())))] = value
+
+@app.get("/api/metrics")
+async def metrics():
+    """Metrics in Prometheus text exposition format"""
+    lines = []
+    for (name, labels), value in sorted(METRICS.items()):
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+# ==================== CONDITIONAL GET ====================
+# Read endpoints the marketplace polls carry ETags derived from versioned
+# state (tags generation, purchases in the database, tier), so a repeat request is
+# answered with a 304 before any upstream or database work. Bodies are
+# serialised and compressed once per ETag and then reused.
+
+# Smaller bodies aren't worth compressing
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "512"))
+
+# Unique to this process. ETags built from process-local state (like the
+# tags generation) must include it, so they never match in another worker
+# or after a restart. ETags built from the database don't need it.
+_ETAG_EPOCH = uuid.uuid4().hex[:8]
+
+# (etag, content encoding) -> encoded body
+_encoded_bodies = OrderedDict()
+ENCODED_BODY_CACHE_SIZE = int(os.getenv("ENCODED_BODY_CACHE_SIZE", "512"))
+
+# Brotli is optional - without it clients get gzip
+_brotli = None
+
+def get_brotli():
+    """Import brotli on first use; False if it isn't installed"""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli
+
+def make_etag(*parts) -> str:
+    """Weak ETag - the same one covers the gzip, brotli and identity bodies"""
+    import hashlib
+    digest = hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    if header.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in header.split(",") if tag.strip())
+
+def _pick_encoding(request: Request) -> str:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").lower().split(","):
+        name, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(name.strip())
+    if "br" in accepted and get_brotli():
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+def _encoded_body(etag: str, encoding: str, encode) -> bytes:
+    key = (etag, encoding)
+    body = _encoded_bodies.get(key)
+    if body is None:
+        body = encode()
+        _encoded_bodies[key] = body
+        if len(_encoded_bodies) > ENCODED_BODY_CACHE_SIZE:
+            _encoded_bodies.popitem(last=False)
+    else:
+        _encoded_bodies.move_to_end(key)
+    return body
+
+def conditional_json(request: Request, etag: str, build, cache_control: str = "private, no-cache",
+                     vary: str = "Accept-Encoding, Cookie") -> Response:
+    """
+    304 if the client already has `etag`, else the JSON of build() -
+    compressed when large enough. build() only runs the first time an
+    ETag is served, so it may do the expensive part of the handler.
+    """
+    route = request.url.path
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": vary}
+    if etag_matches(request, etag):
+        inc_metric("http_not_modified_total", route=route)
+        return Response(status_code=304, headers=headers)
+
+    body = _encoded_body(etag, "identity", lambda: json.dumps(
+        build(), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode())
+    encoding = _pick_encoding(request)
+    if encoding != "identity" and len(body) >= COMPRESS_MIN_BYTES:
+        import gzip
+        compress = (lambda: get_brotli().compress(body)) if encoding == "br" else (lambda: gzip.compress(body, 6))
+        body = _encoded_body(etag, encoding, compress)
+        headers["Content-Encoding"] = encoding
+    else:
+        encoding = "identity"
+
+    inc_metric("http_response_bytes_total", len(body), route=route, encoding=encoding)
+    return Response(body, media_type="application/json", headers=headers)
+
+# ==================== DIAGNOSTICS ====================
+# Opt-in (DIAGNOSTICS_MODE=true). A lag monitor measures how late the event
+# loop wakes up from a short sleep; a watchdog thread captures the stack of
+# whatever is hogging the loop while a stall is still in progress. A sample
+# of requests is run under cProfile so blocking code can be found in prod.
+
+DIAGNOSTICS_MODE = os.getenv("DIAGNOSTICS_MODE", "false").lower() == "true"
+DIAG_LAG_INTERVAL_SECONDS = float(os.getenv("DIAG_LAG_INTERVAL_SECONDS", "0.05"))
+DIAG_LAG_THRESHOLD_MS = float(os.getenv("DIAG_LAG_THRESHOLD_MS", "100"))
+DIAG_PROFILE_SAMPLE_RATE = float(os.getenv("DIAG_PROFILE_SAMPLE_RATE", "0.01"))
+
+# Debug endpoints below are disabled unless DEBUG_TOKEN is set, and then
+# require it in the X-Debug-Token header
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# Most recent stalls and sampled request profiles
+STALLS = deque(maxlen=50)
+PROFILES = deque(maxlen=20)
+
+_loop_heartbeat = time.monotonic()
+
+def _describe_task(task) -> str:
+    if task is None:
+        return "<no task - loop callback>"
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', repr(coro))})"
+
+def _stall_watchdog(loop, loop_thread_id: int):
+    """
+    Runs in a daemon thread. When the loop heartbeat is older than the
+    threshold, record the loop thread's current stack - i.e. the code that
+    is blocking - once per stall.
+    """
+    threshold = DIAG_LAG_THRESHOLD_MS / 1000
+    captured_for = None
+    while not loop.is_closed():
+        time.sleep(threshold / 2)
+        heartbeat = _loop_heartbeat
+        if time.monotonic() - heartbeat - DIAG_LAG_INTERVAL_SECONDS < threshold or captured_for == heartbeat:
+            continue
+        captured_for = heartbeat
+        frame = sys._current_frames().get(loop_thread_id)
+        STALLS.append({
+            "detected_at": time.time(),
+            "task": _describe_task(asyncio.current_task(loop)),
+            "stack": "".join(traceback.format_stack(frame)) if frame else "",
+            "lag_ms": None,  # filled in by the lag monitor once the loop wakes up
+        })
+        print(f"[DIAGNOSTICS] Event loop blocked > {DIAG_LAG_THRESHOLD_MS:.0f}ms in {STALLS[-1]['task']}")
+
+async def _lag_monitor_loop():
+    global _loop_heartbeat
+    while True:
+        started = time.monotonic()
+        _loop_heartbeat = started
+        await asyncio.sleep(DIAG_LAG_INTERVAL_SECONDS)
+        lag = time.monotonic() - started - DIAG_LAG_INTERVAL_SECONDS
+        set_metric("event_loop_lag_seconds", round(lag, 6))
+        if lag * 1000 >= DIAG_LAG_THRESHOLD_MS:
+            inc_metric("event_loop_stalls_total")
+            if STALLS and STALLS[-1]["lag_ms"] is None:
+                STALLS[-1]["lag_ms"] = round(lag * 1000, 1)
+
+def start_lag_monitor() -> asyncio.Task:
+    """Start the lag monitor task and its watchdog thread (called from lifespan)"""
+    loop = asyncio.get_running_loop()
+    threading.Thread(
+        target=_stall_watchdog, args=(loop, threading.get_ident()),
+        name="loop-watchdog", daemon=True
+    ).start()
+    print(f"[DIAGNOSTICS] Enabled - lag threshold {DIAG_LAG_THRESHOLD_MS:.0f}ms, "
+          f"profiling {DIAG_PROFILE_SAMPLE_RATE:.0%} of requests")
+    return asyncio.create_task(_lag_monitor_loop())
+
+_profile_lock = threading.Lock()
+
+async def profile_requests(request: Request, call_next):
+    """
+    Run a random sample of requests under cProfile. cProfile sees the whole
+    thread, so a profile covers everything the event loop ran while this
+    request was in flight - which is exactly where blocking calls show up.
+    Only one request is profiled at a time.
+    """
+    if random.random() >= DIAG_PROFILE_SAMPLE_RATE or not _profile_lock.acquire(blocking=False):
+        return await call_next(request)
+
+    import cProfile
+    profile = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profile.enable()
+        try:
+            return await call_next(request)
+        finally:
+            profile.disable()
+            profile.create_stats()
+            PROFILES.append({
+                "id": uuid.uuid4().hex[:12],
+                "method": request.method,
+                "path": request.url.path,
+                "started_at": time.time(),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                "stats": profile.stats,
+            })
+    finally:
+        _profile_lock.release()
+
+if DIAGNOSTICS_MODE:
+    app.middleware("http")(profile_requests)
+
+def require_debug_token(request: Request):
+    if not DEBUG_TOKEN:
+        raise HTTPException(404, "Not Found")
+    if request.headers.get("x-debug-token") != DEBUG_TOKEN:
+        raise HTTPException(403, "Invalid debug token")
+
+@app.get("/api/debug/stalls")
+async def debug_stalls(request: Request):
+    """Recent event-loop stalls with the stack that was running"""
+    require_debug_token(request)
+    return {
+        "diagnostics_mode": DIAGNOSTICS_MODE,
+        "threshold_ms": DIAG_LAG_THRESHOLD_MS,
+        "stalls": list(STALLS),
+    }
+
+@app.get("/api/debug/profiles")
+async def debug_profiles(request: Request):
+    """List sampled request profiles (newest last)"""
+    require_debug_token(request)
+    return {
+        "sample_rate": DIAG_PROFILE_SAMPLE_RATE,
+        "profiles": [{k: v for k, v in p.items() if k != "stats"} for p in PROFILES],
+    }
+
+@app.get("/api/debug/profiles/{profile_id}")
+async def debug_profile(profile_id: str, request: Request, format: str = Query("pstats")):
+    """
+    Download one profile - format=pstats gives a file for
+    `python -m pstats` / snakeviz, format=text a cumulative-time summary
+    """
+    require_debug_token(request)
+    entry = next((p for p in PROFILES if p["id"] == profile_id), None)
+    if entry is None:
+        raise HTTPException(404, "Profile not found")
+
+    if format == "text":
+        import io
+        import pstats
+        out = io.StringIO()
+        stats = pstats.Stats(stream=out)
+        stats.stats = dict(entry["stats"])
+        stats.get_top_level_stats()
+        stats.sort_stats("cumulative").print_stats(40)
+        return PlainTextResponse(out.getvalue())
+
+    import marshal
+    return Response(
+        marshal.dumps(entry["stats"]),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.pstats"'}
+    )
+
+# ==================== CIRCUIT BREAKERS ====================
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))              # calls considered
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))         # before the rate is trusted
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))   # failure ratio that opens it
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "60"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "15"))
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+class CircuitBreaker:
+    """
+    Closed -> open when the failure ratio over the last BREAKER_WINDOW calls
+    reaches BREAKER_ERROR_RATE (calls slower than BREAKER_SLOW_CALL_SECONDS
+    count as failures). Open -> half-open after the cooldown, letting one
+    trial call through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)  # True = failure
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        set_metric("circuit_breaker_state", 0, breaker=name)
+
+    def _transition(self, new_state: str):
+        print(f"[BREAKER] {self.name}: {self.state} -> {new_state}")
+        inc_metric("circuit_breaker_transitions_total", breaker=self.name, from_state=self.state, to_state=new_state)
+        set_metric("circuit_breaker_state", BREAKER_STATES[new_state], breaker=self.name)
+        self.state = new_state
+        if new_state == "open":
+            self.opened_at = time.monotonic()
+        elif new_state == "closed":
+            self.outcomes.clear()
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream right now (cheap, never blocks)"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN_SECONDS:
+                inc_metric("circuit_breaker_rejected_total", breaker=self.name)
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.trial_in_flight:
+                inc_metric("circuit_breaker_rejected_total", breaker=self.name)
+                return False
+            self.trial_in_flight = True
+        return True
+
+    def release(self):
+        """Call finished without telling us anything about upstream health"""
+        self.trial_in_flight = False
+
+    def record_success(self, latency: float):
+        if latency > BREAKER_SLOW_CALL_SECONDS:
+            self.record_failure()
+            return
+        self.trial_in_flight = False
+        if self.state == "half_open":
+            self._transition("closed")
+        else:
+            self.outcomes.append(False)
+
+    def record_failure(self):
+        self.trial_in_flight = False
+        if self.state == "half_open":
+            self._transition("open")
+            return
+        self.outcomes.append(True)
+        if (self.state == "closed" and len(self.outcomes) >= BREAKER_MIN_CALLS
+                and sum(self.outcomes) / len(self.outcomes) >= BREAKER_ERROR_RATE):
+            self._transition("open")
+
+BREAKERS = {}
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """One breaker per upstream ("ollama", "gumroad") or upstream model ("ollama:<model>")"""
+    breaker = BREAKERS.get(name)
+    if breaker is None:
+        breaker = BREAKERS[name] = CircuitBreaker(name)
+    return breaker
+
+# ==================== RATE LIMITING ====================
+# Token buckets keyed by (route, client). A client is its validated license
+# key (pro tier), else its user_id cookie, else its IP address. Clients of
+# every tier also share a per-IP bucket so rotating cookies or keys doesn't help.
+
+# route -> tier -> (requests per second, burst)
+RATE_LIMITS = {
+    "chat": {"free": (0.2, 5), "pro": (1.0, 20)},
+    "install": {"free": (1 / 60, 2), "pro": (0.1, 5)},
+    "license": {"free": (0.1, 5), "pro": (0.5, 10)},
+}
+# e.g. RATE_LIMITS_JSON='{"chat": {"free": [0.5, 10]}}'
+for _route, _tiers in json.loads(os.getenv("RATE_LIMITS_JSON", "{}")).items():
+    RATE_LIMITS.setdefault(_route, {}).update({tier: tuple(limit) for tier, limit in _tiers.items()})
+
+# How many times the per-client limit all clients of a tier behind one IP may use
+RATE_LIMIT_IP_MULTIPLIER = float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "4"))
+
+# Generated (eval) tokens per hour per client, charged from Ollama's eval_count
+GENERATION_QUOTAS = {
+    "free": int(os.getenv("GENERATION_QUOTA_FREE", "20000")),
+    "pro": int(os.getenv("GENERATION_QUOTA_PRO", "200000")),
+}
+
+# Only these peers are believed when they send X-Forwarded-For (nginx, Docker networks)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(net.strip())
+    for net in os.getenv("TRUSTED_PROXIES", "127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128").split(",")
+    if net.strip()
+]
+
+class TokenBucket:
+    """Two floats per client - tokens left and when they were last refilled"""
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, rate: float, capacity: float):
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def take(self, rate: float, capacity: float, cost: float = 1.0) -> float:
+        """Take cost tokens; returns 0 on success, else seconds until possible"""
+        self.refill(rate, capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / rate if rate > 0 else 3600.0
+
+# Least recently used first - at the cap the oldest bucket is evicted in O(1)
+BUCKETS = OrderedDict()
+MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+def _get_bucket(key: tuple, capacity: float, create: bool = True):
+    """The bucket for key; a missing one is created full, or None if not create"""
+    bucket = BUCKETS.get(key)
+    if bucket is not None:
+        BUCKETS.move_to_end(key)
+    elif create:
+        while len(BUCKETS) >= MAX_BUCKETS:
+            BUCKETS.popitem(last=False)
+        bucket = BUCKETS[key] = TokenBucket(capacity)
+    return bucket
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+def client_ip(request: HTTPConnection) -> str:
+    """
+    Client address, honouring X-Forwarded-For only from trusted proxies:
+    walk the chain right to left and take the first untrusted hop
+    """
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(peer):
+        return peer
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+def client_identity(request: HTTPConnection):
+    """Returns (tier, client key, ip) for rate limiting"""
+    ip = client_ip(request)
+    license_key = request.headers.get("x-license-key") or request.cookies.get("license_key")
+    # Only keys that already passed /api/license/validate - otherwise a new
+    # made-up key per request would get a fresh pro bucket every time. DEV-
+    # keys pass without Gumroad, so they unlock models but never pro limits.
+    if license_key and license_key in VALID_LICENSES and not license_key.startswith("DEV-"):
+        return "pro", f"license:{license_key}", ip
+    user_id = request.cookies.get("user_id")
+    if user_id:
+        return "free", f"user:{user_id}", ip
+    return "free", f"ip:{ip}", ip
+
+def _too_many_requests(message: str, retry_after: float, route: str, tier: str):
+    inc_metric("rate_limited_total", route=route, tier=tier)
+    raise HTTPException(
+        status_code=429,
+        detail=message,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+def check_rate_limit(request: HTTPConnection, route: str):
+    """Raise 429 with Retry-After if this client is over its limit for route"""
+    tier, client, ip = client_identity(request)
+    rate, burst = RATE_LIMITS[route][tier]
+
+    # Every tier also shares a per-IP bucket, so rotating cookies or keys doesn't
+    # help. It goes first so a rejected request never creates a client bucket.
+    wait = 0.0
+    if not client.startswith("ip:"):
+        ip_rate, ip_burst = rate * RATE_LIMIT_IP_MULTIPLIER, burst * RATE_LIMIT_IP_MULTIPLIER
+        wait = _get_bucket((route, f"ip:{ip}"), ip_burst).take(ip_rate, ip_burst)
+    if not wait:
+        wait = _get_bucket((route, client), burst).take(rate, burst)
+    if wait:
+        _too_many_requests("Too many requests - please slow down.", wait, route, tier)
+
+def _generation_buckets(request: HTTPConnection, create: bool = True):
+    """
+    Returns (tier, [(bucket, hourly quota), ...]) - the quota shared by the
+    client's IP, so a new cookie doesn't mean a new quota, and its own.
+    With create=False a client without a bucket yet (a full quota) is left out.
+    """
+    tier, client, ip = client_identity(request)
+    quota = GENERATION_QUOTAS[tier]
+    limits = [(client, quota)]
+    if not client.startswith("ip:"):
+        limits.insert(0, (f"ip:{ip}", quota * RATE_LIMIT_IP_MULTIPLIER))
+    buckets = []
+    for key, limit in limits:
+        bucket = _get_bucket(("generation", key), limit, create)
+        if bucket is not None:
+            bucket.refill(limit / 3600, limit)
+            buckets.append((bucket, limit))
+    return tier, buckets
+
+def check_generation_quota(request: HTTPConnection):
+    """Raise 429 while this client's (or its IP's) generation quota is used up"""
+    tier, buckets = _generation_buckets(request, create=False)
+    for bucket, quota in buckets:
+        if bucket.tokens <= 0:
+            _too_many_requests(
+                f"Hourly generation quota reached ({GENERATION_QUOTAS[tier]} tokens). Upgrade to Pro for more.",
+                -bucket.tokens / (quota / 3600) + 1, "generation", tier
+            )
+
+def charge_generation(request: HTTPConnection, eval_count: int):
+    """Debit generated tokens after the fact; the balance may go negative"""
+    tier, buckets = _generation_buckets(request)
+    for bucket, _ in buckets:
+        bucket.tokens -= eval_count
+    inc_metric("generated_tokens_total", eval_count, tier=tier)
+
+# ==================== USAGE ACCOUNTING ====================
+# Every completed generation appends one tuple to an in-memory ring buffer.
+# A background task drains it every USAGE_FLUSH_SECONDS in a single SQLite
+# transaction, pre-aggregating the batch into the hourly/daily rollups.
+
+USAGE_BUFFER_SIZE = int(os.getenv("USAGE_BUFFER_SIZE", "10000"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+USAGE_RAW_RETENTION_DAYS = int(os.getenv("USAGE_RAW_RETENTION_DAYS", "30"))
+
+# If the flusher falls behind, the oldest records are dropped (and counted)
+USAGE_BUFFER = deque(maxlen=USAGE_BUFFER_SIZE)
+
+_usage_flush_lock = asyncio.Lock()
+
+def _usage_client(client: str) -> str:
+    """License keys are secrets - only keep a short hash of them"""
+    if client.startswith("license:"):
+        import hashlib
+        return "license:" + hashlib.sha256(client.encode()).hexdigest()[:16]
+    return client
+
+def record_usage(connection: HTTPConnection, model: str, ollama_model: str, stats: dict, cache_hit: bool = False):
+    """Queue one usage record - O(1), never touches the database"""
+    tier, client, _ = client_identity(connection)
+    if len(USAGE_BUFFER) == USAGE_BUFFER.maxlen:
+        inc_metric("usage_records_dropped_total")
+    USAGE_BUFFER.append((
+        time.time(),
+        _usage_client(client),
+        model,
+        ollama_model,
+        tier,
+        stats.get("prompt_eval_count", 0),
+        stats.get("eval_count", 0),
+        stats.get("total_duration", 0) / 1e6,
+        stats.get("load_duration", 0) / 1e6,
+        stats.get("prompt_eval_duration", 0) / 1e6,
+        stats.get("eval_duration", 0) / 1e6,
+        int(cache_hit),
+    ))
+
+def _rollup(records: list, bucket_seconds: int) -> list:
+    """Aggregate a batch so each rollup row is upserted once per flush"""
+    totals = {}
+    for ts, _, model, ollama_model, tier, prompt_tokens, eval_tokens, total_ms, _, _, _, cache_hit in records:
+        key = (int(ts // bucket_seconds * bucket_seconds), model, ollama_model, tier)
+        row = totals.setdefault(key, [0, 0, 0, 0, 0.0])
+        row[0] += 1
+        row[1] += cache_hit
+        row[2] += prompt_tokens
+        row[3] += eval_tokens
+        row[4] += total_ms
+    return [key + tuple(row) for key, row in totals.items()]
+
+def _write_usage(records: list):
+    """One transaction for the whole batch (runs in a worker thread)"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        with conn:
+            conn.executemany("INSERT INTO usage_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+            for table, bucket_seconds in (("usage_hourly", 3600), ("usage_daily", 86400)):
+                conn.executemany(f'''INSERT INTO {table}
+                    (bucket, model, ollama_model, tier, requests, cache_hits, prompt_tokens, eval_tokens, total_duration_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (bucket, model, ollama_model, tier) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        cache_hits = cache_hits + excluded.cache_hits,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        eval_tokens = eval_tokens + excluded.eval_tokens,
+                        total_duration_ms = total_duration_ms + excluded.total_duration_ms''',
+                    _rollup(records, bucket_seconds))
+            conn.execute("DELETE FROM usage_events WHERE ts < ?",
+                         (time.time() - USAGE_RAW_RETENTION_DAYS * 86400,))
+    finally:
+        conn.close()
+
+async def flush_usage():
+    """Drain the ring buffer into SQLite"""
+    async with _usage_flush_lock:
+        if not USAGE_BUFFER:
+            return
+        records = [USAGE_BUFFER.popleft() for _ in range(len(USAGE_BUFFER))]
+        try:
+            await asyncio.to_thread(_write_usage, records)
+            inc_metric("usage_records_flushed_total", len(records))
+        except Exception as e:
+            # Put them back ahead of anything queued meanwhile. If they no
+            # longer fit, the oldest of them are dropped (and counted).
+            overflow = len(records) + len(USAGE_BUFFER) - USAGE_BUFFER.maxlen
+            if overflow > 0:
+                inc_metric("usage_records_dropped_total", overflow)
+                records = records[overflow:]
+            USAGE_BUFFER.extendleft(reversed(records))
+            print(f"[USAGE] Flush failed, will retry: {type(e).__name__}: {e}")
+
+async def usage_flush_loop():
+    """Background task started by lifespan()"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SECONDS)
+        await flush_usage()
+
+USAGE_GROUPS = {"model", "ollama_model", "tier"}
+
+@app.get("/api/usage")
+async def usage(
+    request: Request,
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    group_by: str = Query("model"),
+    hours: float = Query(24, gt=0),
+):
+    """
+    Usage rollups - e.g. tokens per model per hour over the last `hours`
+    group_by: model, ollama_model or tier (rollups), or client (raw events)
+    Requires X-Debug-Token, like the other operator endpoints
+    """
+    require_debug_token(request)
+    if group_by not in USAGE_GROUPS | {"client"}:
+        raise HTTPException(400, f"group_by must be one of: {', '.join(sorted(USAGE_GROUPS | {'client'}))}")
+
+    await flush_usage()
+    bucket_seconds = 3600 if bucket == "hour" else 86400
+    since = int((time.time() - hours * 3600) // bucket_seconds * bucket_seconds)
+
+    if group_by == "client":
+        query = f'''SELECT CAST(ts / {bucket_seconds} AS INTEGER) * {bucket_seconds} AS b, client,
+                          COUNT(*), SUM(cache_hit), SUM(prompt_tokens), SUM(eval_tokens), SUM(total_duration_ms)
+                   FROM usage_events WHERE ts >= ? GROUP BY b, client ORDER BY b'''
+    else:
+        table = "usage_hourly" if bucket == "hour" else "usage_daily"
+        query = f'''SELECT bucket, {group_by},
+                          SUM(requests), SUM(cache_hits), SUM(prompt_tokens), SUM(eval_tokens), SUM(total_duration_ms)
+                   FROM {table} WHERE bucket >= ? GROUP BY bucket, {group_by} ORDER BY bucket'''
+
+    def run_query():
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            return conn.execute(query, (since,)).fetchall()
+        finally:
+            conn.close()
+
+    rows = await asyncio.to_thread(run_query)
+    return {
+        "bucket": bucket,
+        "group_by": group_by,
+        "since": since,
+        "rows": [{
+            "bucket": b,
+            group_by: key,
+            "requests": requests,
+            "cache_hits": cache_hits,
+            "prompt_tokens": prompt_tokens,
+            "eval_tokens": eval_tokens,
+            "generation_seconds": round(total_ms / 1000, 3),
+        } for b, key, requests, cache_hits, prompt_tokens, eval_tokens, total_ms in rows],
+    }
+
+# ==================== PROMPT BUDGETING ====================
+# Prompts are measured against the context window of the Ollama model that
+# will actually run them (after breaker degradation) and truncated or
+# rejected before dispatch, so prompt evaluation time has an upper bound.
+# Token counts are estimated - close enough to budget with, and far cheaper
+# than loading real tokenizers into the backend.
+
+# Context for models without a configured window (Ollama's own default)
+DEFAULT_CONTEXT = int(os.getenv("DEFAULT_CONTEXT", "2048"))
+
+# Tokens of each context window kept free for the model's answer
+PROMPT_RESPONSE_RESERVE = int(os.getenv("PROMPT_RESPONSE_RESERVE", "512"))
+
+# What to do with an over-budget prompt: "truncate" (keep start + end) or "reject" (413)
+PROMPT_OVERFLOW = os.getenv("PROMPT_OVERFLOW", "truncate").lower()
+
+# Hard cap on any HTTP request body, enforced while it is being received
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", str(256 * 1024)))
+
+# family -> (characters per token in a word, digits per token), fitted on
+# English prose and code. 32k-vocab SentencePiece models split digits singly.
+TOKENIZER_FAMILIES = {
+    "llama": (3.3, 1),
+    "mistral": (3.3, 1),
+    "phi3": (3.3, 1),
+    "deepseek": (3.6, 3),
+    "llama3": (4.0, 3),
+    "qwen": (3.9, 1),
+    "gemma": (4.0, 1),
+    "default": (3.0, 1),
+}
+
+# Word, digit run, or any other single non-space character (punctuation,
+# CJK and other non-ASCII characters each cost about one token)
+_PRETOKEN = re.compile(r"([A-Za-z]+)|(\d+)|\S")
+
+TRUNCATION_MARKER = "\n\n[... truncated ...]\n\n"
+
+# (family, length, hash) -> estimate; keyed by hash so large prompts aren't kept alive
+_estimate_cache = OrderedDict()
+ESTIMATE_CACHE_SIZE = int(os.getenv("ESTIMATE_CACHE_SIZE", "1024"))
+
+def model_context(ollama_model: str) -> int:
+    return MODEL_REGISTRY.get(ollama_model, {}).get("context", DEFAULT_CONTEXT)
+
+def prompt_budget(ollama_model: str) -> int:
+    """Prompt tokens allowed for a model - its context minus the answer reserve"""
+    context = model_context(ollama_model)
+    return max(context - PROMPT_RESPONSE_RESERVE, context // 2)
+
+def estimate_tokens(text: str, family: str) -> int:
+    """Approximate token count for a tokenizer family (cached)"""
+    key = (family, len(text), hash(text))
+    cached = _estimate_cache.get(key)
+    if cached is not None:
+        _estimate_cache.move_to_end(key)
+        return cached
+
+    chars_per_token, digits_per_token = TOKENIZER_FAMILIES.get(family, TOKENIZER_FAMILIES["default"])
+    tokens = 0
+    for match in _PRETOKEN.finditer(text):
+        if match.lastindex == 1:
+            tokens += math.ceil(len(match.group(1)) / chars_per_token)
+        elif match.lastindex == 2:
+            tokens += math.ceil(len(match.group(2)) / digits_per_token)
+        else:
+            tokens += 1
+
+    _estimate_cache[key] = tokens
+    if len(_estimate_cache) > ESTIMATE_CACHE_SIZE:
+        _estimate_cache.popitem(last=False)
+    return tokens
+
+def _keep_ends(text: str, keep_chars: int) -> str:
+    """Keep the opening (instructions) and, mostly, the end (the actual question)"""
+    head = keep_chars // 4
+    tail = keep_chars - head
+    return text[:head] + TRUNCATION_MARKER + (text[-tail:] if tail else "")
+
+def truncate_to_budget(text: str, family: str, budget: int) -> str:
+    estimate = estimate_tokens(text, family)
+    keep_chars = int(len(text) * budget / max(estimate, 1))
+    for _ in range(8):
+        keep_chars = int(keep_chars * 0.9)
+        candidate = _keep_ends(text, keep_chars)
+        if estimate_tokens(candidate, family) <= budget:
+            return candidate
+    return _keep_ends(text, 0)
+
+def budget_prompt(prompt: str, model: str, ollama_model: str):
+    """
+    Fit a prompt into the context window of ollama_model
+    Returns (prompt, notice) - the notice is non-empty when it was truncated.
+    Raises 413 when it doesn't fit and PROMPT_OVERFLOW is "reject".
+    """
+    family = MODEL_REGISTRY.get(ollama_model, {}).get("family", "default")
+    budget = prompt_budget(ollama_model)
+
+    # No tokenizer packs more than ~4 chars per token, so anything this long
+    # is over budget - don't spend time estimating the whole thing
+    if len(prompt) > budget * 16:
+        estimate = None
+        if PROMPT_OVERFLOW != "reject":
+            prompt = _keep_ends(prompt, budget * 8)
+    else:
+        estimate = estimate_tokens(prompt, family)
+        if estimate <= budget:
+            inc_metric("prompt_budget_total", model=ollama_model, outcome="ok")
+            return prompt, ""
+
+    shown = f"~{estimate}" if estimate is not None else f"more than {budget}"
+    if PROMPT_OVERFLOW == "reject":
+        inc_metric("prompt_budget_total", model=ollama_model, outcome="rejected")
+        print(f"[BUDGET] Rejected {shown}-token prompt for {ollama_model} (budget {budget})")
+        raise HTTPException(
+            status_code=413,
+            detail=f"Message is too long for {model}: {shown} tokens, limit is {budget}. Please shorten it."
+        )
+
+    inc_metric("prompt_budget_total", model=ollama_model, outcome="truncated")
+    print(f"[BUDGET] Truncated {shown}-token prompt for {ollama_model} (budget {budget})")
+    return (
+        truncate_to_budget(prompt, family, budget),
+        f"⚠️ Your message ({shown} tokens) was longer than {model} can read ({budget} tokens) - the middle was cut.\n\n"
+    )
+
+class _BodyTooLarge(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=413, detail=f"Request body larger than {MAX_REQUEST_BODY_BYTES} bytes")
+
+class BodySizeLimitMiddleware:
+    """
+    Reject oversized request bodies as they stream in - by Content-Length up
+    front, else as soon as the received bytes pass the limit - instead of
+    buffering the whole body first. Pure ASGI so it sees receive() directly.
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > self.max_bytes:
+            return await self._reject(scope, receive, send)
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    inc_metric("request_body_rejected_total")
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            # Normally FastAPI turns it into a 413 itself; this covers raw handlers
+            if response_started:
+                raise
+            await self._reject(scope, receive, send)
+
+    async def _reject(self, scope, receive, send):
+        inc_metric("request_body_rejected_total")
+        response = JSONResponse({"detail": _BodyTooLarge().detail}, status_code=413, headers={"Connection": "close"})
+        await response(scope, receive, send)
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_REQUEST_BODY_BYTES)
+
+# ==================== SEMANTIC CACHE ====================
+# Opt-in reuse of answers for near-duplicate prompts ("what is llama" vs
+# "What's Llama?"). Prompts are embedded through Ollama and compared by cosine
+# similarity against a preallocated matrix of unit vectors, one row per cached
+# answer. An answer is only reused for the Ollama model that wrote it.
+
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+SEMANTIC_CACHE_EMBED_MODEL = os.getenv("SEMANTIC_CACHE_EMBED_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_CAPACITY = int(os.getenv("SEMANTIC_CACHE_CAPACITY", "4096"))
+
+# Minimum cosine similarity for a hit, per Ollama model
+# e.g. SEMANTIC_CACHE_THRESHOLDS_JSON='{"deepseek-coder:6.7b": 0.97}'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_THRESHOLDS = {
+    model: float(threshold)
+    for model, threshold in json.loads(os.getenv("SEMANTIC_CACHE_THRESHOLDS_JSON", "{}")).items()
+}
+
+# Keep the index in memory-mapped files under DATA_DIR so it survives restarts.
+# Each uvicorn worker locks its own worker-N subdirectory - workers never share files.
+SEMANTIC_CACHE_PERSIST = os.getenv("SEMANTIC_CACHE_PERSIST", "false").lower() == "true"
+SEMANTIC_CACHE_DIR = os.path.join(DATA_DIR, "semantic-cache")
+
+class SemanticCache:
+    """
+    Fixed-capacity nearest-neighbour index over unit vectors.
+    vectors[i] is a prompt embedding, models[i] the id of the model that
+    answered it (-1 = empty row) and last_used[i] a logical clock for LRU
+    eviction. Answer texts are kept in a list indexed by row.
+    """
+
+    def __init__(self, capacity: int, dim: int, directory: str = ""):
+        import numpy as np
+        self.capacity = capacity
+        self.dim = dim
+        self.directory = directory
+        self.model_ids = {}
+        self.answers = [None] * capacity
+        self.size = 0  # rows in use - searches skip the untouched tail
+        self.clock = 0
+
+        if directory and self._load():
+            return
+        if directory:
+            from numpy.lib.format import open_memmap
+            os.makedirs(directory, exist_ok=True)
+            self.vectors = open_memmap(self._path("vectors.npy"), mode="w+", dtype=np.float32, shape=(capacity, dim))
+            self.models = open_memmap(self._path("models.npy"), mode="w+", dtype=np.int32, shape=(capacity,))
+            self.last_used = open_memmap(self._path("last_used.npy"), mode="w+", dtype=np.int64, shape=(capacity,))
+        else:
+            self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+            self.models = np.empty(capacity, dtype=np.int32)
+            self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.models[:] = -1
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> bool:
+        """Reopen a saved index; False if there is none or its shape differs"""
+        from numpy.lib.format import open_memmap
+        try:
+            with open(self._path("answers.json")) as f:
+                saved = json.load(f)
+            if saved["capacity"] != self.capacity or saved["dim"] != self.dim:
+                print("[CACHE] Saved semantic cache has a different shape - starting empty")
+                return False
+            self.vectors = open_memmap(self._path("vectors.npy"), mode="r+")
+            self.models = open_memmap(self._path("models.npy"), mode="r+")
+            self.last_used = open_memmap(self._path("last_used.npy"), mode="r+")
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self.model_ids = saved["models"]
+        for row, answer in saved["answers"].items():
+            self.answers[int(row)] = answer
+        # Rows stored after the last save have vectors but lost their answer
+        for row in (self.models >= 0).nonzero()[0]:
+            if self.answers[row] is None:
+                self.models[row] = -1
+        used = (self.models >= 0).nonzero()[0]
+        self.size = int(used[-1]) + 1 if len(used) else 0
+        self.clock = int(self.last_used.max())
+        print(f"[CACHE] Loaded {len(used)} semantic cache entries from {self.directory}")
+        return True
+
+    def __len__(self) -> int:
+        return int((self.models[:self.size] >= 0).sum())
+
+    def lookup(self, vector, model: str, threshold: float):
+        """Best cached answer for this model with similarity >= threshold, else None"""
+        import numpy as np
+        model_id = self.model_ids.get(model)
+        if model_id is None or self.size == 0:
+            return None
+        scores = self.vectors[:self.size] @ vector
+        scores = np.where(self.models[:self.size] == model_id, scores, -1.0)
+        row = int(np.argmax(scores))
+        if scores[row] < threshold:
+            return None
+        self.clock += 1
+        self.last_used[row] = self.clock
+        return self.answers[row]
+
+    def store(self, vector, model: str, answer: str):
+        import numpy as np
+        if self.size < self.capacity:
+            row = self.size
+            self.size += 1
+        else:
+            row = int(np.argmin(self.last_used))
+        self.clock += 1
+        self.vectors[row] = vector
+        self.models[row] = self.model_ids.setdefault(model, len(self.model_ids))
+        self.last_used[row] = self.clock
+        self.answers[row] = answer
+
+    def save(self):
+        """Flush the memory maps and write the answers next to them"""
+        if not self.directory:
+            return
+        for array in (self.vectors, self.models, self.last_used):
+            array.flush()
+        tmp_path = self._path("answers.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "capacity": self.capacity,
+                "dim": self.dim,
+                "models": self.model_ids,
+                "answers": {row: answer for row, answer in enumerate(self.answers) if answer is not None},
+            }, f)
+        os.replace(tmp_path, self._path("answers.json"))
+
+# Created on the first embedding, once its dimension is known
+_semantic_cache = None
+SEMANTIC_CACHE_STATS = {"lookups": 0, "hits": 0}
+
+# Held open for the life of the process - the lock on our worker directory
+_semantic_cache_lock = None
+
+def _claim_semantic_cache_dir() -> str:
+    """
+    Lock the first free worker-N directory under SEMANTIC_CACHE_DIR. Slots are
+    reused across restarts, so each worker picks up a saved index again, but
+    two live workers never map the same files.
+    """
+    global _semantic_cache_lock
+    import fcntl
+    for slot in range(64):
+        directory = os.path.join(SEMANTIC_CACHE_DIR, f"worker-{slot}")
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, ".lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        _semantic_cache_lock = lock
+        return directory
+    raise OSError(f"no free semantic cache slot in {SEMANTIC_CACHE_DIR}")
+
+def get_semantic_cache(dim: int) -> Optional[SemanticCache]:
+    global _semantic_cache
+    if _semantic_cache is None:
+        directory = ""
+        if SEMANTIC_CACHE_PERSIST:
+            try:
+                directory = _claim_semantic_cache_dir()
+                _semantic_cache = SemanticCache(SEMANTIC_CACHE_CAPACITY, dim, directory)
+            except (OSError, ImportError, ValueError) as e:
+                # e.g. read-only volume - still cache, just not across restarts
+                print(f"[CACHE] Cannot persist semantic cache ({type(e).__name__}: {e}) - keeping it in memory")
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache(SEMANTIC_CACHE_CAPACITY, dim)
+    return _semantic_cache if _semantic_cache.dim == dim else None
+
+async def embed_prompt(prompt: str):
+    """Embedding of a prompt as a unit vector, or None if Ollama can't provide one"""
+    import numpy as np
+    breaker = get_breaker(f"ollama:{SEMANTIC_CACHE_EMBED_MODEL}")
+    if not breaker.allow():
+        return None
+    started = time.perf_counter()
+    try:
+        response = await OLLAMA_CLIENT.post(
+            f"{OLLAMA_BASE_URL}/api/embed",
+            json={"model": SEMANTIC_CACHE_EMBED_MODEL, "input": prompt},
+            timeout=httpx.Timeout(10.0, connect=2.0)
+        )
+        if response.status_code != 200:
+            # e.g. embedding model not pulled - the breaker stops us asking every time
+            breaker.record_failure()
+            return None
+        breaker.record_success(time.perf_counter() - started)
+        vector = np.asarray(response.json()["embeddings"][0], dtype=np.float32)
+    except Exception:
+        # Unreachable, or a response we can't use - either way no embedding
+        breaker.record_failure()
+        return None
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+async def semantic_lookup(prompt: str, ollama_model: str):
+    """
+    Returns (cached answer or None, vector to store the new answer under)
+    Both are None when the prompt couldn't be embedded.
+    """
+    started = time.perf_counter()
+    vector = await embed_prompt(prompt)
+    embedded = time.perf_counter()
+    inc_metric("semantic_cache_embed_seconds_sum", embedded - started)
+    inc_metric("semantic_cache_embed_seconds_count")
+
+    cache = get_semantic_cache(len(vector)) if vector is not None else None
+    if cache is None:
+        inc_metric("semantic_cache_lookups_total", outcome="error")
+        return None, None
+
+    answer = cache.lookup(vector, ollama_model, SEMANTIC_CACHE_THRESHOLDS.get(ollama_model, SEMANTIC_CACHE_THRESHOLD))
+    inc_metric("semantic_cache_search_seconds_sum", time.perf_counter() - embedded)
+    inc_metric("semantic_cache_search_seconds_count")
+
+    SEMANTIC_CACHE_STATS["lookups"] += 1
+    if answer is not None:
+        SEMANTIC_CACHE_STATS["hits"] += 1
+    inc_metric("semantic_cache_lookups_total", outcome="hit" if answer is not None else "miss")
+    set_metric("semantic_cache_hit_ratio", round(SEMANTIC_CACHE_STATS["hits"] / SEMANTIC_CACHE_STATS["lookups"], 4))
+    return answer, vector
+
+def semantic_store(vector, ollama_model: str, answer: str):
+    cache = get_semantic_cache(len(vector))
+    if cache is not None:
+        cache.store(vector, ollama_model, answer)
+        set_metric("semantic_cache_entries", len(cache))
+
+# ==================== CHAT ====================
+
+# Model used when the requested one has no local equivalent or is unavailable
+FALLBACK_MODEL = "tinyllama:latest"
+
+# Model mapping (some models may need different names for Ollama)
+MODEL_MAP = {
+    "tinyllama:latest": "tinyllama:latest",
+    "llama3.2:3b": "llama3.2:3b",
+    "gemma2:2b": "gemma2:2b",
+    "phi3.5:mini": "phi3.5:mini",
+    "qwen2.5:7b": "qwen2.5:7b",
+    "mistral:7b-instruct-v0.3": "mistral:7b-instruct-v0.3",
+    # Cloud models fallback to TinyLlama (pre-installed)
+    "llama3.3:70b": FALLBACK_MODEL,
+    "qwen2.5:72b": FALLBACK_MODEL,
+    "deepseek:v3": FALLBACK_MODEL,
+    "gpt-4o-mini": FALLBACK_MODEL,
+    "claude-3.5-sonnet": FALLBACK_MODEL,
+    "mistral-large": FALLBACK_MODEL,
+}
+
+def ollama_unreachable_response(model: str) -> ChatResponse:
+    """Chat reply used whenever Ollama cannot be reached"""
+    return ChatResponse(
+        response=f"⚠️ Cannot connect to Ollama at {OLLAMA_BASE_URL}\n\nMake sure Ollama is running:\n  docker ps | grep ollama\n\nIf not running:\n  docker start ollama",
+        model=model
+    )
+
+# Longest a buffered chat request may take, admission to answer. Clients can
+# ask for less with an X-Request-Timeout header (seconds).
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "120"))
+
+def request_deadline(http_request: Request, route_limit: float) -> float:
+    """Monotonic deadline for a request - the route limit or the client's, whichever is sooner"""
+    timeout = route_limit
+    try:
+        requested = float(http_request.headers.get("x-request-timeout", ""))
+        if requested > 0:
+            timeout = min(timeout, requested)
+    except ValueError:
+        pass
+    return time.monotonic() + timeout
+
+async def _wait_for_disconnect(http_request: Request):
+    """Returns once the client has gone away (the body must already be read)"""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def run_until_deadline(http_request: Request, work, deadline: float, route: str):
+    """
+    Await `work` unless the deadline passes or the client disconnects first.
+    Either way the work is cancelled, which closes any upstream request it
+    has open - for Ollama that stops the generation.
+    """
+    started = time.monotonic()
+    task = asyncio.create_task(work)
+    watcher = asyncio.create_task(_wait_for_disconnect(http_request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=max(0.0, deadline - started),
+                                     return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    reason = "disconnect" if watcher in done else "deadline"
+    # Seconds of upstream work thrown away - the capacity a cancellation wasted
+    elapsed = time.monotonic() - started
+    inc_metric("request_cancelled_total", route=route, reason=reason)
+    inc_metric("request_cancelled_seconds_sum", elapsed, route=route, reason=reason)
+    print(f"[CHAT] Cancelled after {elapsed:.1f}s: {reason}")
+    if reason == "disconnect":
+        # Nobody is listening; 499 is what nginx logs for this
+        return Response(status_code=499)
+    raise HTTPException(status_code=504, detail=f"Chat request exceeded its deadline ({elapsed:.0f}s)")
+
+def route_to_ollama(model: str):
+    """
+    Pick the Ollama model for a chat request, consulting the circuit breakers
+    Returns (ollama_model, notice), or (None, message) to fail fast without
+    touching Ollama. Every admitted call must end in record_*() or release().
+    """
+    ollama_model = MODEL_MAP.get(model, FALLBACK_MODEL)
+
+    host_breaker = get_breaker("ollama")
+    if not host_breaker.allow():
+        return None, ollama_unreachable_response(model).response
+
+    if get_breaker(f"ollama:{ollama_model}").allow():
+        return ollama_model, ""
+
+    # Degrade to the pre-installed fallback model while this one is failing
+    if ollama_model != FALLBACK_MODEL and get_breaker(f"ollama:{FALLBACK_MODEL}").allow():
+        print(f"[CHAT] Breaker open for {ollama_model} - degrading to {FALLBACK_MODEL}")
+        return FALLBACK_MODEL, f"⚠️ {ollama_model} is temporarily unavailable - answered by {FALLBACK_MODEL}.\n\n"
+
+    host_breaker.release()
+    return None, f"⚠️ Model '{ollama_model}' is temporarily unavailable after repeated failures.\n\nPlease try again in a few seconds."
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """
     Chat endpoint that routes to Ollama
     Supports all 9 models defined in Local AI Studio
     """
+    deadline = request_deadline(http_request, CHAT_DEADLINE_SECONDS)
+    check_rate_limit(http_request, "chat")
+    check_generation_quota(http_request)
 
-    # Model mapping (some models may need different names for Ollama)
-    model_map = {
-        "tinyllama:latest": "tinyllama:latest",
-        "llama3.2:3b": "llama3.2:3b",
-        "gemma2:2b": "gemma2:2b",
-        "phi3.5:mini": "phi3.5:mini",
-        "qwen2.5:7b": "qwen2.5:7b",
-        "mistral:7b-instruct-v0.3": "mistral:7b-instruct-v0.3",
-        # Cloud models fallback to TinyLlama (pre-installed)
-        "llama3.3:70b": "tinyllama:latest",
-        "qwen2.5:72b": "tinyllama:latest",
-        "deepseek:v3": "tinyllama:latest",
-        "gpt-4o-mini": "tinyllama:latest",
-        "claude-3.5-sonnet": "tinyllama:latest",
-        "mistral-large": "tinyllama:latest",
-    }
+    # Load shedding from the readiness snapshot - fail fast instead of
+    # waiting on a connect timeout when Ollama is known to be down
+    if readiness_fresh() and not READINESS["ollama_reachable"]:
+        return ollama_unreachable_response(request.model)
 
-    ollama_model = model_map.get(request.model, "tinyllama:latest")
+    global CHAT_IN_FLIGHT
+    if CHAT_IN_FLIGHT >= MAX_CHAT_QUEUE_DEPTH:
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy - too many chat requests in progress. Please retry shortly.",
+            headers={"Retry-After": "5"}
+        )
 
+    ollama_model, notice = route_to_ollama(request.model)
+    if ollama_model is None:
+        return ChatResponse(response=notice, model=request.model)
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            # Call Ollama API
-            response = await client.post(
-                f"{OLLAMA_BASE_URL}/api/generate",
-                json={
-                    "model": ollama_model,
-                    "prompt": request.message,
-                    "stream": False
-                }
-            )
+        prompt, budget_notice = budget_prompt(request.message, request.model, ollama_model)
+    except HTTPException:
+        get_breaker("ollama").release()
+        get_breaker(f"ollama:{ollama_model}").release()
+        raise
+    notice += budget_notice
+
+    CHAT_IN_FLIGHT += 1
+    try:
+        return await run_until_deadline(
+            http_request, _answer_chat(request, http_request, ollama_model, prompt, notice), deadline, "chat"
+        )
+    finally:
+        CHAT_IN_FLIGHT -= 1
+
+async def _answer_chat(request: ChatRequest, http_request: Request, ollama_model: str, prompt: str, notice: str):
+    """Answer an admitted chat request from the semantic cache or Ollama"""
+    vector = None
+    if SEMANTIC_CACHE:
+        try:
+            cached, vector = await semantic_lookup(prompt, ollama_model)
+        except asyncio.CancelledError:
+            get_breaker("ollama").release()
+            get_breaker(f"ollama:{ollama_model}").release()
+            raise
+        except Exception as e:
+            # The cache is an optimisation - go to Ollama, which settles the breakers
+            print(f"[CACHE] Semantic lookup failed: {type(e).__name__}: {e}")
+            inc_metric("semantic_cache_lookups_total", outcome="error")
+            cached, vector = None, None
+        if cached is not None:
+            get_breaker("ollama").release()
+            get_breaker(f"ollama:{ollama_model}").release()
+            record_usage(http_request, request.model, ollama_model, {}, cache_hit=True)
+            return ChatResponse(response=notice + cached, model=request.model)
+
+    result, stats = await _chat_with_ollama(request, ollama_model, prompt)
+    if stats:
+        record_usage(http_request, request.model, ollama_model, stats)
+        if vector is not None:
+            try:
+                semantic_store(vector, ollama_model, result.response)
+            except Exception as e:
+                print(f"[CACHE] Semantic store failed: {type(e).__name__}: {e}")
+    if stats.get("eval_count"):
+        charge_generation(http_request, stats["eval_count"])
+    if notice:
+        result.response = notice + result.response
+    return result
 
-            if response.status_code == 200:
-                data = response.json()
-                return ChatResponse(
-                    response=data.get("response", "No response from model"),
-                    model=request.model
-                )
-            elif response.status_code == 404:
-                # Model not found - provide helpful error
-                return ChatResponse(
-                    response=f"⚠️ Model '{ollama_model}' not found in Ollama.\n\nTo download: ssh to VPS and run:\n  docker exec ollama ollama pull {ollama_model}\n\nCurrently testing with IP: {OLLAMA_BASE_URL}",
-                    model=request.model
-                )
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Ollama error")
+async def _chat_with_ollama(request: ChatRequest, ollama_model: str, prompt: str):
+    """
+    Send one non-streaming generate request to Ollama
+    Outcomes are recorded on the upstream and per-model breakers
+    Returns (ChatResponse, Ollama's final stats - empty unless it generated)
+    """
+    host_breaker = get_breaker("ollama")
+    model_breaker = get_breaker(f"ollama:{ollama_model}")
+    started = time.perf_counter()
+    try:
+        # Call Ollama API
+        response = await OLLAMA_CLIENT.post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={
+                "model": ollama_model,
+                "prompt": prompt,
+                "stream": False,
+                # Always the same per model, so Ollama never reloads it for a new size
+                "options": {"num_ctx": model_context(ollama_model)}
+            }
+        )
+
+        # A 5xx means Ollama is up but the model failed to load or generate
+        latency = time.perf_counter() - started
+        host_breaker.record_success(latency)
+        if response.status_code >= 500:
+            model_breaker.record_failure()
+        else:
+            model_breaker.record_success(latency)
+
+        if response.status_code == 200:
+            data = response.json()
+            return ChatResponse(
+                response=data.get("response", "No response from model"),
+                model=request.model
+            ), data
+        elif response.status_code == 404:
+            # Model not found - provide helpful error
+            return ChatResponse(
+                response=f"⚠️ Model '{ollama_model}' not found in Ollama.\n\nTo download: ssh to VPS and run:\n  docker exec ollama ollama pull {ollama_model}\n\nCurrently testing with IP: {OLLAMA_BASE_URL}",
+                model=request.model
+            ), {}
+        else:
+            raise HTTPException(status_code=response.status_code, detail="Ollama error")
 
     except httpx.ConnectError:
-        return ChatResponse(
-            response=f"⚠️ Cannot connect to Ollama at {OLLAMA_BASE_URL}\n\nMake sure Ollama is running:\n  docker ps | grep ollama\n\nIf not running:\n  docker start ollama",
-            model=request.model
-        )
+        host_breaker.record_failure()
+        model_breaker.release()
+        return ollama_unreachable_response(request.model), {}
+    except asyncio.CancelledError:
+        # Deadline or client disconnect. Only a call that was already slow
+        # says something about upstream health.
+        if time.perf_counter() - started > BREAKER_SLOW_CALL_SECONDS:
+            host_breaker.record_failure()
+            model_breaker.record_failure()
+        else:
+            host_breaker.release()
+            model_breaker.release()
+        raise
     except Exception as e:
+        if isinstance(e, httpx.TimeoutException):
+            # A wedged generation counts against both the model and the host,
+            # so a fully hung Ollama opens the upstream breaker too
+            host_breaker.record_failure()
+            model_breaker.record_failure()
+        elif not isinstance(e, HTTPException):
+            host_breaker.record_failure()
+            model_breaker.release()
         return ChatResponse(
             response=f"⚠️ Error: {str(e)}\n\nBackend is working but Ollama connection failed.",
             model=request.model
-        )
+        ), {}
+
+# ==================== WEBSOCKET CHAT ====================
+# One connection, many concurrent generations multiplexed by request id.
+#
+# Client -> server:
+#   {"type": "chat", "id": "r1", "message": "...", "model": "llama3.2:3b"}
+#   {"type": "cancel", "id": "r1"}
+# Server -> client:
+#   {"type": "token", "id": "r1", "content": "..."}
+#   {"type": "done", "id": "r1", "model": "...", "eval_count": 42}
+#   {"type": "cancelled", "id": "r1"}
+#   {"type": "error", "id": "r1", "error": "...", "retry_after": 5}
+
+# Concurrent generations allowed on one connection
+WS_MAX_GENERATIONS = int(os.getenv("WS_MAX_GENERATIONS", "4"))
+
+# Outgoing frames buffered per connection. When a slow client lets this
+# fill up, generations stop reading from Ollama until it drains.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+
+async def stream_generate(ollama_model: str, prompt: str):
+    """
+    Stream Ollama generate chunks (dicts) for an admitted model, recording
+    the outcome on the circuit breakers. The model's latency is its time to
+    first token - a long answer is not a slow model. Closing the generator
+    early (e.g. on cancellation) closes the upstream connection, which stops Ollama.
+    """
+    host_breaker = get_breaker("ollama")
+    model_breaker = get_breaker(f"ollama:{ollama_model}")
+    started = time.perf_counter()
+    finished = False
+    first_token = False
+    try:
+        async with OLLAMA_CLIENT.stream(
+            "POST",
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={
+                "model": ollama_model,
+                "prompt": prompt,
+                "stream": True,
+                "options": {"num_ctx": model_context(ollama_model)}
+            }
+        ) as response:
+            host_breaker.record_success(time.perf_counter() - started)
+            if response.status_code != 200:
+                if response.status_code >= 500:
+                    model_breaker.record_failure()
+                else:
+                    model_breaker.release()
+                finished = True
+                raise HTTPException(response.status_code, f"Ollama error ({response.status_code})")
+
+            async for line in response.aiter_lines():
+                if line.strip():
+                    if not first_token:
+                        first_token = True
+                        model_breaker.record_success(time.perf_counter() - started)
+                    yield json.loads(line)
+
+        if not first_token:
+            model_breaker.record_success(time.perf_counter() - started)
+        finished = True
+    except httpx.ConnectError:
+        host_breaker.record_failure()
+        model_breaker.release()
+        finished = True
+        raise
+    except httpx.TimeoutException:
+        host_breaker.record_failure()
+        model_breaker.record_failure()
+        finished = True
+        raise
+    finally:
+        if not finished:
+            # Cancelled or the consumer stopped early - says nothing about health
+            host_breaker.release()
+            if not first_token:
+                model_breaker.release()
+
+def _http_error_frame(request_id: str, error: HTTPException) -> dict:
+    frame = {"type": "error", "id": request_id, "error": error.detail}
+    retry_after = (error.headers or {}).get("Retry-After")
+    if retry_after:
+        frame["retry_after"] = int(retry_after)
+    return frame
+
+async def _ws_generation(websocket: WebSocket, outbox: asyncio.Queue, request_id: str, request: ChatRequest):
+    """Run one generation, pushing frames into the connection's outbox"""
+    global CHAT_IN_FLIGHT
+
+    # Same admission control as POST /api/chat
+    try:
+        check_rate_limit(websocket, "chat")
+        check_generation_quota(websocket)
+        if readiness_fresh() and not READINESS["ollama_reachable"]:
+            raise HTTPException(503, ollama_unreachable_response(request.model).response)
+        if CHAT_IN_FLIGHT >= MAX_CHAT_QUEUE_DEPTH:
+            raise HTTPException(503, "Server busy - too many chat requests in progress. Please retry shortly.",
+                                headers={"Retry-After": "5"})
+    except HTTPException as e:
+        await outbox.put(_http_error_frame(request_id, e))
+        return
+
+    ollama_model, notice = route_to_ollama(request.model)
+    if ollama_model is None:
+        await outbox.put({"type": "error", "id": request_id, "error": notice})
+        return
+    try:
+        prompt, budget_notice = budget_prompt(request.message, request.model, ollama_model)
+    except HTTPException as e:
+        get_breaker("ollama").release()
+        get_breaker(f"ollama:{ollama_model}").release()
+        await outbox.put(_http_error_frame(request_id, e))
+        return
+    notice += budget_notice
+
+    CHAT_IN_FLIGHT += 1
+    # Until stream_generate() starts, the breaker slots route_to_ollama() took are ours to give back
+    streaming = False
+    try:
+        if notice:
+            await outbox.put({"type": "token", "id": request_id, "content": notice})
+        streaming = True
+        # aclosing() shuts the upstream stream even when we're cancelled mid-put
+        async with aclosing(stream_generate(ollama_model, prompt)) as chunks:
+            async for chunk in chunks:
+                if chunk.get("response"):
+                    # Blocks while the outbox is full - that is the backpressure
+                    await outbox.put({"type": "token", "id": request_id, "content": chunk["response"]})
+                if chunk.get("done"):
+                    record_usage(websocket, request.model, ollama_model, chunk)
+                    if chunk.get("eval_count"):
+                        charge_generation(websocket, chunk["eval_count"])
+                    await outbox.put({
+                        "type": "done",
+                        "id": request_id,
+                        "model": request.model,
+                        "eval_count": chunk.get("eval_count", 0),
+                    })
+    except asyncio.CancelledError:
+        # Never block here: the sender may already be gone
+        try:
+            outbox.put_nowait({"type": "cancelled", "id": request_id})
+        except asyncio.QueueFull:
+            pass
+        raise
+    except HTTPException as e:
+        await outbox.put(_http_error_frame(request_id, e))
+    except httpx.ConnectError:
+        await outbox.put({"type": "error", "id": request_id, "error": ollama_unreachable_response(request.model).response})
+    except Exception as e:
+        await outbox.put({"type": "error", "id": request_id, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        if not streaming:
+            # e.g. cancelled while the outbox was full - a half-open breaker
+            # would otherwise wait forever for this trial to finish
+            get_breaker("ollama").release()
+            get_breaker(f"ollama:{ollama_model}").release()
+        CHAT_IN_FLIGHT -= 1
+
+async def _ws_sender(websocket: WebSocket, outbox: asyncio.Queue):
+    while True:
+        await websocket.send_json(await outbox.get())
+
+@app.websocket("/api/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Multiplexed streaming chat - see the protocol above
+    Tokens stream back as Ollama produces them; generations can be cancelled in flight
+    """
+    await websocket.accept()
+    outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+    sender = asyncio.create_task(_ws_sender(websocket, outbox))
+    generations = {}
+
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError):
+                await outbox.put({"type": "error", "id": None, "error": "Invalid JSON frame"})
+                continue
+            if not isinstance(message, dict):
+                await outbox.put({"type": "error", "id": None, "error": "Frames must be JSON objects"})
+                continue
+            request_id = str(message.get("id", ""))
+
+            if message.get("type") == "cancel":
+                task = generations.get(request_id)
+                if task:
+                    task.cancel()
+                continue
+
+            if message.get("type") != "chat" or not request_id:
+                await outbox.put({"type": "error", "id": request_id or None, "error": "Expected {type: chat|cancel, id: ...}"})
+                continue
+            if request_id in generations:
+                await outbox.put({"type": "error", "id": request_id, "error": "Request id already in use"})
+                continue
+            if len(generations) >= WS_MAX_GENERATIONS:
+                await outbox.put({"type": "error", "id": request_id, "error": f"At most {WS_MAX_GENERATIONS} concurrent generations per connection"})
+                continue
+            try:
+                request = ChatRequest(message=message.get("message", ""), model=message.get("model", FALLBACK_MODEL))
+            except ValueError as e:
+                await outbox.put({"type": "error", "id": request_id, "error": str(e)})
+                continue
+
+            task = asyncio.create_task(_ws_generation(websocket, outbox, request_id, request))
+            generations[request_id] = task
+            task.add_done_callback(lambda _, rid=request_id: generations.pop(rid, None))
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Client went away - stop every generation so Ollama stops too
+        for task in list(generations.values()):
+            task.cancel()
+        await asyncio.gather(*generations.values(), return_exceptions=True)
+        sender.cancel()
 
 @app.get("/api/models")
-async def list_models():
+async def list_models(request: Request):
     """List available Ollama models with simplified format for frontend"""
+    # Served from the background snapshot while it is fresh; the ETag
+    # changes only when the installed model list does
+    if readiness_fresh() and READINESS["ollama_reachable"]:
+        installed = READINESS["installed_models"]
+        return conditional_json(
+            request,
+            make_etag("models", _ETAG_EPOCH, READINESS["tags_generation"]),
+            lambda: {"installed": installed, "count": len(installed)},
+            cache_control=f"public, max-age={int(READINESS_REFRESH_SECONDS)}",
+            vary="Accept-Encoding",
+        )
+
     try:
         async with httpx.AsyncClient(timeout=10.0) as client:
             response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
@@ -203,24 +1999,26 @@ async def list_models():
         return {"installed": [], "count": 0, "error": str(e)}
 
 @app.post("/api/models/install")
-async def install_model_post(request: InstallRequest):
+async def install_model_post(request: InstallRequest, http_request: Request):
     """
     One-click model installation endpoint with REAL Ollama streaming
     Streams download progress via Server-Sent Events (SSE)
     POST version for API calls
     """
+    check_rate_limit(http_request, "install")
     model = request.model
 
     print(f"\n[MODEL INSTALL] Starting installation: {model}")
     return await _install_model_stream(model)
 
 @app.get("/api/models/install")
-async def install_model_get(model: str):
+async def install_model_get(model: str, http_request: Request):
     """
     One-click model installation endpoint with REAL Ollama streaming
     Streams download progress via Server-Sent Events (SSE)
     GET version for EventSource compatibility
     """
+    check_rate_limit(http_request, "install")
     print(f"\n[MODEL INSTALL] Starting installation (GET): {model}")
     return await _install_model_stream(model)
 
@@ -288,6 +2086,8 @@ async def _install_model_stream(model: str):
 
                 # Send completion event
                 print(f"[MODEL INSTALL] Installation complete: {model}")
+                # Pick up the new model now rather than on the next refresh tick
+                await refresh_readiness()
                 yield f"data: {json.dumps({'status': 'success', 'message': f'Model {model} installed successfully'})}\n\n"
 
             except httpx.ConnectError as e:
@@ -317,26 +2117,31 @@ async def _install_model_stream(model: str):
 async def check_model_status(model: str):
     """
     Check if a specific model is installed
+    Answered from the readiness snapshot when it is fresh
     """
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            if response.status_code == 200:
-                data = response.json()
-                installed = [m['name'] for m in data.get('models', [])]
-
-                # Check if model is installed (handle version tags)
-                is_installed = any(
-                    m == model or m.startswith(model.split(':')[0])
-                    for m in installed
-                )
+        if readiness_fresh():
+            if not READINESS["ollama_reachable"]:
+                return {"model": model, "installed": False, "error": READINESS["errors"].get("ollama")}
+            installed = READINESS["installed_models"]
+        else:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
+                if response.status_code != 200:
+                    return {"model": model, "installed": False}
+                installed = [m['name'] for m in response.json().get('models', [])]
+
+        # Check if model is installed (handle version tags)
+        is_installed = any(
+            m == model or m.startswith(model.split(':')[0])
+            for m in installed
+        )
 
-                return {
-                    "model": model,
-                    "installed": is_installed,
-                    "all_installed": installed
-                }
-            return {"model": model, "installed": False}
+        return {
+            "model": model,
+            "installed": is_installed,
+            "all_installed": installed
+        }
     except Exception as e:
         return {"model": model, "installed": False, "error": str(e)}
 
@@ -373,27 +2178,48 @@ def record_purchase(user_id: str, model_id: str, stripe_session_id: str = ""):
     conn.commit()
     conn.close()
 
+def purchases_version(user_id: str) -> tuple:
+    """
+    (count, newest rowid) of a user's purchases. Read from the database, so
+    it changes in every worker as soon as any of them records a purchase.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        return conn.execute('SELECT COUNT(*), MAX(rowid) FROM purchases WHERE user_id = ?',
+                            (user_id,)).fetchone()
+    finally:
+        conn.close()
+
 @app.get("/api/models/owned")
-async def get_owned_models(user_id: Optional[str] = Cookie(None)):
+async def get_owned_models(request: Request, user_id: Optional[str] = Cookie(None)):
     """Get list of models this user owns"""
-    user_id = get_user_id(user_id)
+    def owned_models(user_id: str) -> dict:
+        # Always include TinyLlama (free)
+        owned = ["tinyllama:latest"]
 
-    # Always include TinyLlama (free)
-    owned = ["tinyllama:latest"]
+        # Get purchased models
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('SELECT model_id FROM purchases WHERE user_id = ?', (user_id,))
+        purchased = [row[0] for row in c.fetchall()]
+        conn.close()
 
-    # Get purchased models
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT model_id FROM purchases WHERE user_id = ?', (user_id,))
-    purchased = [row[0] for row in c.fetchall()]
-    conn.close()
+        owned.extend(purchased)
 
-    owned.extend(purchased)
+        return {
+            "owned": owned,
+            "user_id": user_id  # Return for cookie setting
+        }
 
-    return {
-        "owned": owned,
-        "user_id": user_id  # Return for cookie setting
-    }
+    # New visitors get a fresh user id each time - nothing to revalidate
+    if not user_id:
+        return owned_models(get_user_id(user_id))
+
+    return conditional_json(
+        request,
+        make_etag("owned", user_id, *purchases_version(user_id)),
+        lambda: owned_models(user_id),
+    )
 
 @app.post("/api/models/purchase/{model_id}")
 async def create_purchase_intent(
@@ -446,7 +2272,10 @@ async def create_purchase_intent(
 
     try:
         # Create Stripe checkout session
-        checkout_session = stripe.checkout.Session.create(
+        stripe = get_stripe()
+        # Blocking HTTP call in the SDK - keep it off the event loop
+        checkout_session = await asyncio.to_thread(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
@@ -491,6 +2320,7 @@ async def stripe_webhook(request: Request):
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
 
+    stripe = get_stripe()
     try:
         # Verify webhook signature
         event = stripe.Webhook.construct_event(
@@ -523,12 +2353,28 @@ async def stripe_webhook(request: Request):
 class LicenseRequest(BaseModel):
     license_key: str
 
+async def _verify_with_gumroad(license_key: str) -> httpx.Response:
+    """Try license key verification first"""
+    async with httpx.AsyncClient(timeout=15.0) as client:
+        return await client.post(
+            f"{GUMROAD_API_BASE}/v2/licenses/verify",
+            data={
+                "product_permalink": GUMROAD_PRODUCT_PERMALINK,
+                "license_key": license_key
+            },
+            headers={"Authorization": f"Bearer {GUMROAD_API_KEY}"}
+        )
+
 @app.post("/api/license/validate")
-async def validate_license(request: LicenseRequest):
+async def validate_license(request: LicenseRequest, http_request: Request = None):
     """
     Validate license key via Gumroad API
     Instant monetization - no Stripe approval needed
     """
+    # Internal callers pass no http_request and do their own limiting
+    if http_request is not None:
+        check_rate_limit(http_request, "license")
+
     try:
         license_key = request.license_key.strip()
 
@@ -563,17 +2409,26 @@ async def validate_license(request: LicenseRequest):
         safe_key = GUMROAD_API_KEY[:10] + "..." if GUMROAD_API_KEY and len(GUMROAD_API_KEY) > 10 else "INVALID"
         print(f"[LICENSE VALIDATE] API key configured: {safe_key}")
 
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # Try license key verification first
-            response = await client.post(
-                "https://api.gumroad.com/v2/licenses/verify",
-                data={
-                    "product_permalink": GUMROAD_PRODUCT_PERMALINK,
-                    "license_key": license_key
-                },
-                headers={"Authorization": f"Bearer {GUMROAD_API_KEY}"}
-            )
+        gumroad_breaker = get_breaker("gumroad")
+        if not gumroad_breaker.allow():
+            print("[LICENSE VALIDATE] Gumroad breaker open - failing fast")
+            return JSONResponse({
+                "valid": False,
+                "message": "License server temporarily unavailable. Please try again shortly."
+            }, status_code=503)
+
+        gumroad_started = time.perf_counter()
+        try:
+            response = await _verify_with_gumroad(license_key)
+        except httpx.HTTPError:
+            gumroad_breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            gumroad_breaker.record_failure()
+        else:
+            gumroad_breaker.record_success(time.perf_counter() - gumroad_started)
 
+        async with httpx.AsyncClient(timeout=15.0) as client:
             # If license verification fails, try order ID lookup
             if response.status_code != 200 or not response.json().get("success", False):
                 print(f"[LICENSE VALIDATE] License verification failed, trying order ID lookup...")
@@ -582,7 +2437,7 @@ async def validate_license(request: LicenseRequest):
                 # and v2/sales expects a product ID (not permalink) for filtering.
                 # We'll verify the product in the response instead.
                 sales_response = await client.get(
-                    "https://api.gumroad.com/v2/sales",
+                    f"{GUMROAD_API_BASE}/v2/sales",
                     params={
                         "order_id": license_key
                     },
@@ -642,64 +2497,13 @@ async def validate_license(request: LicenseRequest):
         }, status_code=500)
 
 
-            print(f"[LICENSE VALIDATE] Gumroad response status: {response.status_code}")
-            print(f"[LICENSE VALIDATE] Gumroad response body: {response.text[:500]}")
-
-            if response.status_code == 200:
-                data = response.json()
-
-                # Check if purchase/subscription is valid
-                purchase = data.get("purchase", {})
-                success = data.get("success", False)
-                refunded = purchase.get("refunded", True)
-                cancelled = purchase.get("subscription_cancelled_at")
-                failed = purchase.get("subscription_failed_at")
-
-                print(f"[LICENSE VALIDATE] Gumroad validation - success: {success}, refunded: {refunded}, cancelled: {cancelled}, failed: {failed}")
-
-                if (success and
-                    refunded == False and
-                    cancelled is None and
-                    failed is None):
-
-                    # Cache valid license
-                    VALID_LICENSES.add(license_key)
-                    buyer_email = purchase.get("email", "")
-                    print(f"[LICENSE VALIDATE] ✅ Valid license! Buyer: {buyer_email}")
-
-                    return JSONResponse({
-                        "valid": True,
-                        "tier": "pro",
-                        "buyer_email": buyer_email,
-                        "message": "Pro license activated!"
-                    })
-                else:
-                    print(f"[LICENSE VALIDATE] ❌ Invalid license - failed validation checks")
-
-            print(f"[LICENSE VALIDATE] ❌ Invalid license - bad status code or data")
-            return JSONResponse({
-                "valid": False,
-                "message": "Invalid or refunded license key"
-            })
-
-    except httpx.TimeoutException as e:
-        print(f"[LICENSE VALIDATE] ⚠️ Timeout error: {str(e)}")
-        return JSONResponse({
-            "valid": False,
-            "message": "Gumroad API timeout. Please try again."
-        })
-    except Exception as e:
-        print(f"[LICENSE VALIDATE] ❌ Exception: {type(e).__name__}: {str(e)}")
-        import traceback
-        print(f"[LICENSE VALIDATE] Traceback: {traceback.format_exc()}")
-        return JSONResponse({
-            "valid": False,
-            "message": f"Validation error: {str(e)}"
-        })
-
+TIER_RESPONSES = {
+    "free": {"tier": "free", "models": FREE_MODELS, "message": "Free tier (3 models)"},
+    "pro": {"tier": "pro", "models": PRO_MODELS, "message": "Pro tier (all 11 models)"},
+}
 
 @app.get("/api/license/check")
-async def check_license(license_key: Optional[str] = Query(None), cookie_key: Optional[str] = Cookie(None, alias="license_key")):
+async def check_license(request: Request, license_key: Optional[str] = Query(None), cookie_key: Optional[str] = Cookie(None, alias="license_key")):
     """
     Check user's current tier based on license key
     Returns available models for their tier
@@ -708,29 +2512,50 @@ async def check_license(license_key: Optional[str] = Query(None), cookie_key: Op
     """
     # Prefer query param (from localStorage), fallback to cookie
     final_key = license_key if license_key else cookie_key
-    
+    # Known keys are answered (304 included) from local state alone
+    tier = cached_tier(final_key) or await resolve_tier(final_key, request)
+    return conditional_json(request, make_etag("license", TIER_RESPONSES[tier]), lambda: TIER_RESPONSES[tier])
+
+def cached_tier(final_key: Optional[str]) -> Optional[str]:
+    """Tier for a key from the local validation caches, or None if Gumroad must be asked"""
+    if not final_key or known_invalid_license(final_key):
+        return "free"
+    if final_key in VALID_LICENSES:
+        return "pro"
+    return None
+
+async def resolve_tier(final_key: Optional[str], request: Request = None) -> str:
+    """
+    "pro" or "free" for a license key - answered locally for known keys,
+    otherwise validated with Gumroad (which caches valid keys)
+    """
     print(f"\n[LICENSE CHECK] Checking license status...")
     print(f"[LICENSE CHECK] License key: {final_key[:20] + '...' if final_key and len(final_key) > 20 else final_key}")
 
     # No license = free tier
     if not final_key:
         print("[LICENSE CHECK] No license key provided - returning free tier")
-        return JSONResponse({
-            "tier": "free",
-            "models": FREE_MODELS,
-            "message": "Free tier (3 models)"
-        })
+        return "free"
 
     # Check cache first
     if final_key in VALID_LICENSES:
         print(f"[LICENSE CHECK] ✅ License key found in cache - returning pro tier")
-        return JSONResponse({
-            "tier": "pro",
-            "models": PRO_MODELS,
-            "message": "Pro tier (all 11 models)"
-        })
+        return "pro"
+
+    if known_invalid_license(final_key):
+        print("[LICENSE CHECK] License key recently rejected - returning free tier")
+        return "free"
 
     print(f"[LICENSE CHECK] License key not in cache, validating with Gumroad...")
+    if request is not None:
+        try:
+            check_rate_limit(request, "license")
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise
+            # Polling endpoints - degrade to free rather than failing the page
+            print("[LICENSE CHECK] Rate limited - returning free tier without validating")
+            return "free"
 
     # Validate license (adds to cache if valid)
     try:
@@ -748,21 +2573,16 @@ async def check_license(license_key: Optional[str] = Query(None), cookie_key: Op
 
         if validation_data.get("valid"):
             print(f"[LICENSE CHECK] ✅ License validated successfully - returning pro tier")
-            return JSONResponse({
-                "tier": "pro",
-                "models": PRO_MODELS,
-                "message": "Pro tier (all 11 models)"
-            })
+            return "pro"
+        # Only a definite "no" is cached - not 503s from the breaker or server errors
+        if getattr(validation_result, "status_code", 200) == 200:
+            remember_invalid_license(final_key)
     except Exception as e:
         print(f"[LICENSE CHECK] ❌ Validation error: {str(e)}")
 
     # Invalid license = free tier
     print("[LICENSE CHECK] ❌ Invalid license - returning free tier")
-    return JSONResponse({
-        "tier": "free",
-        "models": FREE_MODELS,
-        "message": "Free tier (3 models)"
-    })
+    return "free"
 
 @app.get("/api/debug/config")
 async def debug_config():
@@ -779,32 +2599,28 @@ async def debug_config():
     }
 
 @app.get("/api/models/available")
-async def get_available_models(license_key: Optional[str] = Cookie(None)):
+async def get_available_models(request: Request, license_key: Optional[str] = Cookie(None)):
     """
     Get list of models available to user based on license
     Used by frontend to show/hide pro models
     """
     print(f"\n[MODELS AVAILABLE] Checking available models for user...")
 
-    license_check_result = await check_license(license_key)
-
-    # Extract JSON from JSONResponse if needed
-    if isinstance(license_check_result, JSONResponse):
-        import json
-        license_data = json.loads(license_check_result.body.decode())
-    else:
-        license_data = license_check_result
-
-    tier = license_data.get("tier", "free")
-    models = license_data.get("models", FREE_MODELS)
+    tier = cached_tier(license_key) or await resolve_tier(license_key, request)
+    models = TIER_RESPONSES[tier]["models"]
 
     print(f"[MODELS AVAILABLE] Tier: {tier}, Models: {len(models)}")
 
-    return JSONResponse({
-        "tier": tier,
-        "models": models,
-        "total": len(models)
-    })
+    return conditional_json(
+        request,
+        make_etag("available", tier, models),
+        lambda: {"tier": tier, "models": models, "total": len(models)},
+    )
+
+# Everything above is defined at import time; the rest of startup
+# (config logging, migrations) happens in lifespan()
+STARTUP_TIMES["import"] = time.perf_counter() - _IMPORT_STARTED
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
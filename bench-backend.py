@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Load-test and benchmark harness for the Local AI Studio backend
+
+Starts stub-upstreams.py (fake Ollama + Gumroad) and backend-chat.py on
+free local ports, drives a mixed workload with N concurrent clients and
+reports throughput, p50/p95/p99 latency per workload and event-loop lag.
+
+Event-loop lag is measured by probing /api/health (which does no I/O)
+every 50ms during the run: any latency above the idle baseline is time
+the request spent waiting for the backend's event loop. The probe runs in
+its own process, so the load generator's scheduling delay isn't counted.
+
+Usage:
+  python bench-backend.py                                   # default mix, 20s
+  python bench-backend.py --mix chat=1 --concurrency 32     # chat only
+  python bench-backend.py --save bench-results/base.json
+  python bench-backend.py --compare bench-results/base.json # exit 1 on regression
+  python bench-backend.py --backend-url http://localhost:8000 --mix models=1,ready=1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).parent
+
+DEFAULT_MIX = "chat=35,chat_stream=15,models=15,status=10,license=15,install=5,ready=5"
+
+LAG_PROBE_INTERVAL = 0.05
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def spawn(app: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+async def wait_until(url: str, proc: subprocess.Popen = None, timeout: float = 30.0):
+    """Poll url until it answers 200"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"{url}: process exited\n{proc.stderr.read().decode()}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+# ==================== WORKLOADS ====================
+# Each workload makes one request and returns True on success.
+# Failures are counted separately so they don't hide in latency numbers.
+
+CHAT_MODELS = ["tinyllama:latest", "llama3.2:3b", "gemma2:2b", "qwen2.5:7b"]
+CHAT_PROMPTS = [
+    "What is llama?",
+    "Explain transformers in one paragraph.",
+    "Write a haiku about local AI.",
+    "Summarize the benefits of running models offline. " * 8,
+]
+
+
+async def chat(client: httpx.AsyncClient) -> bool:
+    response = await client.post("/api/chat", json={
+        "message": random.choice(CHAT_PROMPTS),
+        "model": random.choice(CHAT_MODELS),
+    })
+    return response.status_code == 200 and not response.json()["response"].startswith("⚠️")
+
+
+async def chat_stream(client: httpx.AsyncClient) -> bool:
+    """One generation over the WebSocket channel, read until done"""
+    import websockets
+    url = str(client.base_url).replace("http", "ws", 1).rstrip("/") + "/api/chat/ws"
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({
+            "type": "chat",
+            "id": "1",
+            "message": random.choice(CHAT_PROMPTS),
+            "model": random.choice(CHAT_MODELS),
+        }))
+        while True:
+            frame = json.loads(await ws.recv())
+            if frame["type"] != "token":
+                return frame["type"] == "done"
+
+
+async def models(client: httpx.AsyncClient) -> bool:
+    response = await client.get("/api/models")
+    return response.status_code == 200 and "error" not in response.json()
+
+
+async def status(client: httpx.AsyncClient) -> bool:
+    response = await client.get(f"/api/models/status/{random.choice(CHAT_MODELS)}")
+    return response.status_code == 200 and "error" not in response.json()
+
+
+async def license_validate(client: httpx.AsyncClient) -> bool:
+    # Fresh keys so every request reaches (stub) Gumroad instead of the cache
+    key = f"{random.choice(['VALID', 'BOGUS'])}-{uuid.uuid4()}"
+    response = await client.post("/api/license/validate", json={"license_key": key})
+    return response.status_code == 200 and response.json()["valid"] == key.startswith("VALID-")
+
+
+async def install(client: httpx.AsyncClient) -> bool:
+    model = f"bench-{uuid.uuid4().hex[:8]}:latest"
+    async with client.stream("POST", "/api/models/install", json={"model": model}) as response:
+        if response.status_code != 200:
+            return False
+        last = ""
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                last = line
+    return '"success"' in last
+
+
+async def ready(client: httpx.AsyncClient) -> bool:
+    return (await client.get("/api/ready")).status_code == 200
+
+
+WORKLOADS = {
+    "chat": chat,
+    "chat_stream": chat_stream,
+    "models": models,
+    "status": status,
+    "license": license_validate,
+    "install": install,
+    "ready": ready,
+}
+
+
+# ==================== RUNNER ====================
+
+class Stats:
+    def __init__(self):
+        self.latencies = {name: [] for name in WORKLOADS}
+        self.errors = {name: 0 for name in WORKLOADS}
+
+
+async def client_loop(base_url: str, mix: list, weights: list, stop_at: float, stats: Stats):
+    async with httpx.AsyncClient(base_url=base_url, timeout=150.0) as client:
+        while time.monotonic() < stop_at:
+            name = random.choices(mix, weights)[0]
+            started = time.perf_counter()
+            try:
+                ok = await WORKLOADS[name](client)
+            except Exception:
+                # e.g. a closed WebSocket or a malformed frame - one failed
+                # request, not a reason to abort the whole run
+                ok = False
+            elapsed = time.perf_counter() - started
+            if ok:
+                stats.latencies[name].append(elapsed)
+            else:
+                stats.errors[name] += 1
+
+
+async def probe_health(client: httpx.AsyncClient) -> float:
+    started = time.perf_counter()
+    await client.get("/api/health")
+    return time.perf_counter() - started
+
+
+async def lag_probe(base_url: str, stop_at: float, baseline: float) -> list:
+    lag = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0) as client:
+        while time.time() < stop_at:
+            lag.append(max(0.0, await probe_health(client) - baseline))
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+    return lag
+
+
+def run_lag_probe(base_url: str, stop_at: float, baseline: float) -> list:
+    """Probe process entry point - a loop shared with the clients would report their delay too"""
+    return asyncio.run(lag_probe(base_url, stop_at, baseline))
+
+
+async def idle_health_baseline(base_url: str) -> float:
+    async with httpx.AsyncClient(base_url=base_url, timeout=5.0) as client:
+        for _ in range(5):
+            await probe_health(client)  # warm the connection
+        return statistics.median([await probe_health(client) for _ in range(50)])
+
+
+async def run_load(base_url: str, mix: dict, concurrency: int, duration: float) -> dict:
+    baseline = await idle_health_baseline(base_url)
+    stats = Stats()
+    names, weights = list(mix), list(mix.values())
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        # Wall clock: the deadline is shared with the probe process
+        probe = asyncio.get_running_loop().run_in_executor(
+            pool, run_lag_probe, base_url, time.time() + duration, baseline
+        )
+        stop_at = time.monotonic() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(base_url, names, weights, stop_at, stats) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        lag = await probe
+
+    workloads = {}
+    for name in names:
+        samples = stats.latencies[name]
+        workloads[name] = {
+            "requests": len(samples),
+            "errors": stats.errors[name],
+            "rps": round(len(samples) / elapsed, 2),
+            "p50_ms": round(percentile(samples, 50) * 1000, 1),
+            "p95_ms": round(percentile(samples, 95) * 1000, 1),
+            "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        }
+    total = sum(w["requests"] for w in workloads.values())
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "total_rps": round(total / elapsed, 2),
+        "total_errors": sum(w["errors"] for w in workloads.values()),
+        "workloads": workloads,
+        "event_loop_lag": {
+            "idle_health_ms": round(baseline * 1000, 2),
+            "p50_ms": round(percentile(lag, 50) * 1000, 1),
+            "p99_ms": round(percentile(lag, 99) * 1000, 1),
+            "max_ms": round(max(lag, default=0) * 1000, 1),
+        },
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions vs a saved result: throughput drop or p95 increase beyond tolerance"""
+    problems = []
+    for name, current in result["workloads"].items():
+        before = baseline["workloads"].get(name)
+        if not before or not before["requests"]:
+            continue
+        if current["rps"] < before["rps"] * (1 - tolerance):
+            problems.append(f"{name}: throughput {current['rps']} rps < {before['rps']} rps -{tolerance:.0%}")
+        if current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {current['p95_ms']}ms > {before['p95_ms']}ms +{tolerance:.0%}")
+        if current["errors"] > before["errors"]:
+            problems.append(f"{name}: errors {current['errors']} > {before['errors']}")
+    lag_now, lag_before = result["event_loop_lag"]["p99_ms"], baseline["event_loop_lag"]["p99_ms"]
+    # Small absolute lag is noise; only flag once it is also above 5ms
+    if lag_now > max(5.0, lag_before * (1 + tolerance)):
+        problems.append(f"event loop lag p99 {lag_now}ms > {lag_before}ms +{tolerance:.0%}")
+    return problems
+
+
+def print_report(result: dict):
+    print(f"\n{'workload':<12} {'req':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    print("─" * 64)
+    for name, w in result["workloads"].items():
+        print(f"{name:<12} {w['requests']:>7} {w['errors']:>5} {w['rps']:>8} "
+              f"{w['p50_ms']:>9} {w['p95_ms']:>9} {w['p99_ms']:>9}")
+    print("─" * 64)
+    print(f"{'total':<12} {'':>7} {result['total_errors']:>5} {result['total_rps']:>8}")
+    lag = result["event_loop_lag"]
+    print(f"\nEvent-loop lag: p50 {lag['p50_ms']}ms, p99 {lag['p99_ms']}ms, max {lag['max_ms']}ms "
+          f"(idle /api/health {lag['idle_health_ms']}ms)")
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOADS:
+            raise SystemExit(f"Unknown workload '{name}'. Available: {', '.join(WORKLOADS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main_async(args) -> dict:
+    procs = []
+    data_dir = tempfile.TemporaryDirectory()
+    try:
+        base_url = args.backend_url
+        if not base_url:
+            stub_url = args.stub_url
+            if not stub_url:
+                stub_port = free_port()
+                stub_url = f"http://127.0.0.1:{stub_port}"
+                stub_env = dict(os.environ,
+                                STUB_LATENCY_MS=str(args.stub_latency_ms),
+                                STUB_TOKENS_PER_SEC=str(args.tokens_per_sec),
+                                STUB_TOKENS=str(args.tokens),
+                                STUB_MODEL_LOAD_MS=str(args.model_load_ms),
+                                STUB_ERROR_RATE=str(args.error_rate))
+                procs.append(spawn("stub-upstreams:app", stub_port, stub_env))
+                await wait_until(f"{stub_url}/api/tags", procs[-1])
+
+            backend_port = free_port()
+            base_url = f"http://127.0.0.1:{backend_port}"
+            backend_env = dict(os.environ,
+                               OLLAMA_BASE_URL=stub_url,
+                               GUMROAD_API_BASE=stub_url,
+                               GUMROAD_API_KEY="bench-key",
+                               DATA_DIR=data_dir.name,
+                               DEMO_MODE="false",
+                               READINESS_REFRESH_SECONDS="1",
+                               # All load comes from one IP - measure throughput, not the
+                               # rate limiter (override with --backend-env to test limits)
+                               RATE_LIMITS_JSON=json.dumps({route: {"free": [1e6, 1e6], "pro": [1e6, 1e6]}
+                                                            for route in ("chat", "install", "license")}),
+                               GENERATION_QUOTA_FREE="1000000000")
+            backend_env.update(dict(kv.split("=", 1) for kv in args.backend_env))
+            procs.append(spawn("backend-chat:app", backend_port, backend_env))
+            await wait_until(f"{base_url}/api/ready", procs[-1])
+
+        print(f"Benchmarking {base_url} for {args.duration}s with {args.concurrency} clients")
+        result = await run_load(base_url, parse_mix(args.mix), args.concurrency, args.duration)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait(timeout=10)
+        data_dir.cleanup()
+
+    result["config"] = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "mix": args.mix,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "stub": None if args.backend_url or args.stub_url else {
+            "latency_ms": args.stub_latency_ms,
+            "tokens_per_sec": args.tokens_per_sec,
+            "tokens": args.tokens,
+            "model_load_ms": args.model_load_ms,
+            "error_rate": args.error_rate,
+        },
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"workload weights (default {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--backend-url", help="benchmark an already running backend instead of spawning one")
+    parser.add_argument("--stub-url", help="use an already running stub instead of spawning one")
+    parser.add_argument("--backend-env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the spawned backend")
+    parser.add_argument("--stub-latency-ms", type=float, default=20.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0)
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per completion")
+    parser.add_argument("--model-load-ms", type=float, default=500.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--save", type=Path, help="write results as JSON")
+    parser.add_argument("--compare", type=Path, help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed regression (default 15%%)")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print_report(result)
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(result, indent=2) + "\n")
+        print(f"\nSaved to {args.save}")
+
+    if args.compare:
+        problems = compare(result, json.loads(args.compare.read_text()), args.tolerance)
+        if problems:
+            print("\n✗ Performance regression:")
+            for problem in problems:
+                print(f"  • {problem}")
+            sys.exit(1)
+        print("\n✓ No performance regression")
+
+
+if __name__ == "__main__":
+    main()
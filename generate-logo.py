@@ -2,15 +2,32 @@
 """
 Generate Local AI Studio Logo using FAL AI
 Creates multiple logo variations for Product Hunt submission
+
+Variants are generated concurrently (--concurrency) with retry/backoff and
+downloaded to disk in chunks. Results are cached by a hash of the prompt
+and generation parameters under logos/.cache, so unchanged prompts are
+skipped and an interrupted run picks up where it stopped (including
+half-finished downloads). Use --force to regenerate everything.
+
+Test against the local stub:
+  uvicorn stub-upstreams:app --port 9000
+  ZAI_API_KEY=test python generate-logo.py --api-base http://localhost:9000
 """
 
+import argparse
+import asyncio
+import hashlib
 import os
-import requests
+import random
 import json
+import shutil
 from pathlib import Path
 
+import httpx
+
 # Check for API key
 ZAI_API_KEY = os.getenv('ZAI_API_KEY', '')
+ZAI_API_BASE = os.getenv('ZAI_API_BASE', 'https://api.z.ai').rstrip('/')
 
 # Logo prompts - 4 different styles
 LOGO_PROMPTS = {
@@ -50,49 +67,154 @@ LOGO_PROMPTS = {
 OUTPUT_DIR = Path(__file__).parent / "logos"
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-def generate_logo_with_zai(prompt: str, filename: str):
-    """Generate logo using Z.AI Flux Pro model"""
-
-    print(f"🎨 Generating: {filename}...")
-
-    url = "https://api.z.ai/v1/images/generations"
-
-    headers = {
-        "Authorization": f"Bearer {ZAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    payload = {
-        "model": "flux-pro",  # High quality model
-        "prompt": prompt,
-        "size": "1024x1024",  # High res
-        "n": 1,
-        "response_format": "url"
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
+# Content-addressed cache: <key>.png is a finished image, <key>.json records
+# the generated image URL so an interrupted download doesn't cost a new generation
+CACHE_DIR = OUTPUT_DIR / ".cache"
 
-        data = response.json()
-        image_url = data['data'][0]['url']
-
-        # Download the image
-        img_response = requests.get(image_url, timeout=30)
-        img_response.raise_for_status()
-
-        output_path = OUTPUT_DIR / filename
-        with open(output_path, 'wb') as f:
-            f.write(img_response.content)
+GENERATION_PARAMS = {
+    "model": "flux-pro",  # High quality model
+    "size": "1024x1024",  # High res
+    "n": 1,
+    "response_format": "url"
+}
 
-        print(f"   ✓ Saved: {filename} ({len(img_response.content) // 1024} KB)")
+MAX_ATTEMPTS = 4
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def cache_key(prompt: str) -> str:
+    """Hash of everything that determines the image"""
+    payload = json.dumps({"prompt": prompt, **GENERATION_PARAMS}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+async def with_retries(label: str, call):
+    """Retry transient failures with exponential backoff (honours Retry-After)"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await call()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            if attempt == MAX_ATTEMPTS or (status is not None and status not in RETRY_STATUSES):
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            if status is not None and e.response.headers.get("retry-after", "").isdigit():
+                delay = int(e.response.headers["retry-after"])
+            print(f"   ↻ {label}: {status or type(e).__name__}, retrying in {delay:.1f}s ({attempt}/{MAX_ATTEMPTS})")
+            await asyncio.sleep(delay)
+
+async def request_image_url(client: httpx.AsyncClient, prompt: str) -> str:
+    response = await client.post(
+        f"{ZAI_API_BASE}/v1/images/generations",
+        headers={
+            "Authorization": f"Bearer {ZAI_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={"prompt": prompt, **GENERATION_PARAMS},
+        timeout=60
+    )
+    response.raise_for_status()
+    return response.json()['data'][0]['url']
+
+def discard_partial(dest: Path):
+    for leftover in (dest.with_suffix(dest.suffix + ".part"), dest.with_suffix(dest.suffix + ".part.url")):
+        leftover.unlink(missing_ok=True)
+
+async def download(client: httpx.AsyncClient, url: str, dest: Path) -> int:
+    """
+    Stream url to dest in chunks via a .part file. An existing .part file
+    is resumed with a Range request when the server supports it - but only
+    if it came from the same URL (recorded next to it in .part.url).
+    """
+    part = dest.with_suffix(dest.suffix + ".part")
+    part_url = dest.with_suffix(dest.suffix + ".part.url")
+    if part.exists() and (not part_url.exists() or part_url.read_text() != url):
+        discard_partial(dest)  # bytes of a different image
+    part_url.write_text(url)
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    async with client.stream("GET", url, headers=headers, timeout=30) as response:
+        if response.status_code == 416 and offset:
+            # Nothing left to send. Done if the part is exactly the full size,
+            # otherwise it is corrupt - fetch the image whole.
+            complete = response.headers.get("content-range", "") == f"bytes */{offset}"
+        else:
+            complete = None
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0  # server ignored the Range header - start over
+            with open(part, "ab" if offset else "wb") as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    if complete is False:
+        discard_partial(dest)
+        return await download(client, url, dest)
+    os.replace(part, dest)
+    part_url.unlink(missing_ok=True)
+    return dest.stat().st_size
+
+async def generate_logo_with_zai(client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                                 prompt: str, filename: str, force: bool = False):
+    """Generate logo using Z.AI Flux Pro model"""
+    key = cache_key(prompt)
+    cached_image = CACHE_DIR / f"{key}.png"
+    pending = CACHE_DIR / f"{key}.json"
+    output_path = OUTPUT_DIR / filename
+
+    if cached_image.exists() and not force:
+        shutil.copyfile(cached_image, output_path)
+        print(f"   ✓ Cached: {filename} ({cached_image.stat().st_size // 1024} KB)")
         return True
 
-    except Exception as e:
-        print(f"   ✗ Error: {e}")
-        return False
+    async with semaphore:
+        print(f"🎨 Generating: {filename}...")
+        try:
+            # Resume a download from a previous, interrupted run
+            image_url = None
+            if pending.exists() and not force:
+                image_url = json.loads(pending.read_text())["url"]
+                try:
+                    size = await with_retries(filename, lambda: download(client, image_url, cached_image))
+                except httpx.HTTPError:
+                    image_url = None  # URL expired - generate again
+                    discard_partial(cached_image)
+                    print(f"   ↻ {filename}: saved image URL no longer valid, regenerating")
+
+            if image_url is None:
+                image_url = await with_retries(filename, lambda: request_image_url(client, prompt))
+                pending.write_text(json.dumps({"url": image_url, "filename": filename}))
+                size = await with_retries(filename, lambda: download(client, image_url, cached_image))
+
+            pending.unlink(missing_ok=True)
+            shutil.copyfile(cached_image, output_path)
+            print(f"   ✓ Saved: {filename} ({size // 1024} KB)")
+            return True
+
+        except Exception as e:
+            print(f"   ✗ Error ({filename}): {e}")
+            return False
+
+async def generate_all(concurrency: int, force: bool) -> dict:
+    CACHE_DIR.mkdir(exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        results = await asyncio.gather(*(
+            generate_logo_with_zai(client, semaphore, prompt, f"logo-{style_name}.png", force)
+            for style_name, prompt in LOGO_PROMPTS.items()
+        ))
+    return dict(zip(LOGO_PROMPTS, results))
 
 def main():
+    global ZAI_API_BASE
+
+    parser = argparse.ArgumentParser(description="Generate Local AI Studio logos")
+    parser.add_argument("--concurrency", type=int, default=2, help="variants generated at once (default 2)")
+    parser.add_argument("--force", action="store_true", help="ignore the cache and regenerate everything")
+    parser.add_argument("--api-base", default=ZAI_API_BASE, help=f"image API base URL (default {ZAI_API_BASE})")
+    args = parser.parse_args()
+    ZAI_API_BASE = args.api_base.rstrip('/')
+
     print("🚀 Generating Local AI Studio Logos...\n")
 
     if not ZAI_API_KEY or ZAI_API_KEY == 'your_api_key_here':
@@ -103,13 +225,16 @@ def main():
     print(f"Using Z.AI API key: {ZAI_API_KEY[:20]}...\n")
 
     # Generate all logo variations
-    for style_name, prompt in LOGO_PROMPTS.items():
-        filename = f"logo-{style_name}.png"
-        generate_logo_with_zai(prompt, filename)
-        print()
+    results = asyncio.run(generate_all(args.concurrency, args.force))
+    failed = [name for name, ok in results.items() if not ok]
 
+    print()
     print("═" * 60)
-    print("✅ Logo generation complete!")
+    if failed:
+        print(f"⚠️  Logo generation finished with {len(failed)} failure(s): {', '.join(failed)}")
+        print("   Re-run to resume - finished variants are cached.")
+    else:
+        print("✅ Logo generation complete!")
     print("═" * 60)
     print(f"\n📁 Logos saved to: {OUTPUT_DIR}")
     print("\nGenerated files:")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Startup-time report for the Local AI Studio backend
+
+Measures:
+  • import time of backend-chat.py in a fresh interpreter
+  • time from process spawn to the first healthy /api/health
+  • that optional integrations (Stripe) are not imported at startup
+
+Usage:
+  python startup-report.py                          # print report
+  python startup-report.py --save startup.json      # store as baseline
+  python startup-report.py --baseline startup.json  # fail on regression
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+
+# Modules that must stay lazy - importing them at startup is a regression
+# (numpy is only needed when the semantic cache is enabled)
+LAZY_MODULES = ["stripe", "uvicorn", "numpy"]
+
+IMPORT_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import importlib
+module = importlib.import_module("backend-chat")
+elapsed = time.perf_counter() - t
+print(json.dumps({
+    "import_s": elapsed,
+    "eager_modules": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import(env: dict) -> dict:
+    """Import the backend in a fresh interpreter and time it"""
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE % (LAZY_MODULES,)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_first_healthy(env: dict, timeout: float = 30.0) -> float:
+    """Spawn uvicorn and poll /api/health until it answers 200"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/api/health"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend-chat:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"backend exited early:\n{proc.stderr.read().decode()}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"/api/health not healthy after {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def run(runs: int) -> dict:
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ, DATA_DIR=data_dir, PYTHONDONTWRITEBYTECODE="1")
+        imports = [measure_import(env) for _ in range(runs)]
+        healthy = [measure_first_healthy(env) for _ in range(runs)]
+
+    return {
+        "runs": runs,
+        "python": sys.version.split()[0],
+        "import_ms": round(statistics.median(i["import_s"] for i in imports) * 1000, 1),
+        "first_healthy_ms": round(statistics.median(healthy) * 1000, 1),
+        "eager_modules": sorted({m for i in imports for m in i["eager_modules"]}),
+    }
+
+
+def check_regression(report: dict, baseline: dict, tolerance: float) -> list:
+    """Return a list of human readable regressions (empty if none)"""
+    problems = []
+    for key in ("import_ms", "first_healthy_ms"):
+        limit = baseline[key] * (1 + tolerance)
+        if report[key] > limit:
+            problems.append(f"{key}: {report[key]}ms > {limit:.1f}ms "
+                            f"(baseline {baseline[key]}ms +{tolerance:.0%})")
+    if report["eager_modules"]:
+        problems.append(f"modules imported eagerly: {', '.join(report['eager_modules'])}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="samples per measurement (median is reported)")
+    parser.add_argument("--save", type=Path, help="write the report as JSON")
+    parser.add_argument("--baseline", type=Path, help="compare against a saved report")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (default 25%%)")
+    args = parser.parse_args()
+
+    report = run(args.runs)
+    print("Backend startup report")
+    print(f"  Import time:        {report['import_ms']} ms")
+    print(f"  First healthy:      {report['first_healthy_ms']} ms")
+    print(f"  Eager lazy modules: {', '.join(report['eager_modules']) or 'none'}")
+
+    if args.save:
+        args.save.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"\nSaved to {args.save}")
+
+    problems = []
+    if args.baseline:
+        problems = check_regression(report, json.loads(args.baseline.read_text()), args.tolerance)
+    elif report["eager_modules"]:
+        problems = [f"modules imported eagerly: {', '.join(report['eager_modules'])}"]
+
+    if problems:
+        print("\n✗ Startup regression:")
+        for problem in problems:
+            print(f"  • {problem}")
+        sys.exit(1)
+    print("\n✓ No startup regression")
+
+
+if __name__ == "__main__":
+    main()
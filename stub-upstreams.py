@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Fake Ollama + Gumroad + Z.AI images for benchmarking without real upstreams
+
+Serves the Ollama endpoints the backend uses (/api/tags, /api/ps,
+/api/generate, /api/embed, /api/pull), the Gumroad ones (/v2/licenses/verify,
+/v2/sales) and the Z.AI image API used by generate-logo.py from one
+process. Behaviour is tuned with env vars or at
+runtime via POST /_stub/config:
+
+  STUB_LATENCY_MS     fixed delay before every response      (default 20)
+  STUB_TOKENS_PER_SEC generation speed                       (default 200)
+  STUB_TOKENS         tokens generated per completion        (default 64)
+  STUB_MODEL_LOAD_MS  delay the first time a model is used   (default 500)
+  STUB_ERROR_RATE     fraction of generate/image calls that 500 (default 0)
+  STUB_IMAGE_KB       size of generated images               (default 256)
+  STUB_EMBED_DIM      embedding dimension                    (default 384)
+
+Gumroad: license keys starting with VALID- verify, everything else fails.
+
+Usage:
+  uvicorn stub-upstreams:app --port 11434
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import zlib
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+
+CONFIG = {
+    "latency_ms": float(os.getenv("STUB_LATENCY_MS", "20")),
+    "tokens_per_sec": float(os.getenv("STUB_TOKENS_PER_SEC", "200")),
+    "tokens": int(os.getenv("STUB_TOKENS", "64")),
+    "model_load_ms": float(os.getenv("STUB_MODEL_LOAD_MS", "500")),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "image_kb": int(os.getenv("STUB_IMAGE_KB", "256")),
+    "embed_dim": int(os.getenv("STUB_EMBED_DIM", "384")),
+}
+
+# Request counters, readable at GET /_stub/stats
+STATS = {"generate": 0, "embed": 0, "image_generations": 0, "image_downloads": 0}
+
+INSTALLED = {"tinyllama:latest", "llama3.2:3b", "gemma2:2b", "qwen2.5:7b", "phi3.5:mini"}
+LOADED = set()
+
+app = FastAPI(title="Stub Ollama + Gumroad")
+
+
+async def upstream_latency():
+    await asyncio.sleep(CONFIG["latency_ms"] / 1000)
+
+
+async def load_model(model: str) -> float:
+    """Simulate Ollama loading weights on first use; returns load seconds"""
+    if model in LOADED:
+        return 0.0
+    load_s = CONFIG["model_load_ms"] / 1000
+    await asyncio.sleep(load_s)
+    LOADED.add(model)
+    return load_s
+
+
+def prompt_tokens(prompt: str) -> int:
+    return max(1, len(prompt) // 4)
+
+
+@app.post("/_stub/config")
+async def update_config(request: Request):
+    """Change stub behaviour while a benchmark is running"""
+    CONFIG.update(await request.json())
+    return CONFIG
+
+
+@app.get("/_stub/stats")
+async def stats():
+    return STATS
+
+
+# ==================== OLLAMA ====================
+
+@app.get("/api/tags")
+async def tags():
+    await upstream_latency()
+    return {"models": [{"name": name} for name in sorted(INSTALLED)]}
+
+
+@app.get("/api/ps")
+async def ps():
+    await upstream_latency()
+    return {"models": [{"name": name} for name in sorted(LOADED)]}
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    model = body.get("model", "")
+    prompt = body.get("prompt", "")
+    stream = body.get("stream", True)
+
+    STATS["generate"] += 1
+    await upstream_latency()
+    if model not in INSTALLED:
+        return JSONResponse({"error": f"model '{model}' not found"}, status_code=404)
+    if random.random() < CONFIG["error_rate"]:
+        return JSONResponse({"error": "stub: injected failure"}, status_code=500)
+
+    started = time.perf_counter()
+    load_s = await load_model(model)
+    n_tokens = CONFIG["tokens"]
+    n_prompt = prompt_tokens(prompt)
+    token_delay = 1 / CONFIG["tokens_per_sec"] if CONFIG["tokens_per_sec"] > 0 else 0
+
+    def final_chunk(text: str) -> dict:
+        total_ns = int((time.perf_counter() - started) * 1e9)
+        return {
+            "model": model,
+            "response": text,
+            "done": True,
+            "total_duration": total_ns,
+            "load_duration": int(load_s * 1e9),
+            "prompt_eval_count": n_prompt,
+            "prompt_eval_duration": 0,
+            "eval_count": n_tokens,
+            "eval_duration": max(0, total_ns - int(load_s * 1e9)),
+        }
+
+    if not stream:
+        await asyncio.sleep(token_delay * n_tokens)
+        return final_chunk(" ".join(f"tok{i}" for i in range(n_tokens)))
+
+    async def tokens():
+        for i in range(n_tokens):
+            await asyncio.sleep(token_delay)
+            yield json.dumps({"model": model, "response": f"tok{i} ", "done": False}) + "\n"
+        yield json.dumps(final_chunk("")) + "\n"
+
+    return StreamingResponse(tokens(), media_type="application/x-ndjson")
+
+
+def embedding(text: str) -> list:
+    """
+    Hashed character-trigram vector of the normalised text, so near-duplicate
+    prompts ("what is llama" / "What's Llama?") land close together. Words
+    under three letters ("is", the "s" of "what's") are dropped, roughly
+    as a real embedding model shrugs off stop words and contractions.
+    """
+    vector = [0.0] * CONFIG["embed_dim"]
+    words = [w for w in re.findall(r"[a-z0-9]+", text.lower()) if len(w) > 2]
+    normalised = " " + " ".join(words) + " "
+    for i in range(len(normalised) - 2):
+        vector[zlib.crc32(normalised[i:i + 3].encode()) % len(vector)] += 1.0
+    return vector
+
+
+@app.post("/api/embed")
+async def embed(request: Request):
+    body = await request.json()
+    inputs = body.get("input", "")
+    STATS["embed"] += 1
+    await upstream_latency()
+    if random.random() < CONFIG["error_rate"]:
+        return JSONResponse({"error": "stub: injected failure"}, status_code=500)
+    texts = [inputs] if isinstance(inputs, str) else inputs
+    return {"model": body.get("model", ""), "embeddings": [embedding(text) for text in texts]}
+
+
+@app.post("/api/pull")
+async def pull(request: Request):
+    body = await request.json()
+    model = body.get("name") or body.get("model", "")
+    await upstream_latency()
+
+    async def progress():
+        total = 10_000_000
+        yield json.dumps({"status": "pulling manifest"}) + "\n"
+        for step in range(1, 11):
+            await asyncio.sleep(0.05)
+            yield json.dumps({"status": "downloading", "total": total, "completed": total * step // 10}) + "\n"
+        INSTALLED.add(model)
+        yield json.dumps({"status": "success"}) + "\n"
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
+
+
+# ==================== GUMROAD ====================
+
+@app.post("/v2/licenses/verify")
+async def verify_license(request: Request):
+    # Parsed by hand so the stub doesn't need python-multipart
+    form = parse_qs((await request.body()).decode())
+    await upstream_latency()
+    if form.get("license_key", [""])[0].startswith("VALID-"):
+        return {"success": True, "purchase": {"refunded": False, "email": "bench@example.com"}}
+    return JSONResponse({"success": False, "message": "That license does not exist."}, status_code=404)
+
+
+@app.get("/v2/sales")
+async def sales(order_id: str = ""):
+    await upstream_latency()
+    return {"success": True, "sales": []}
+
+
+# ==================== Z.AI IMAGES ====================
+
+def image_bytes(image_id: str) -> bytes:
+    """Deterministic fake PNG so repeated/resumed downloads are byte-identical"""
+    body = random.Random(image_id).randbytes(CONFIG["image_kb"] * 1024)
+    return b"\x89PNG\r\n\x1a\n" + body
+
+
+@app.post("/v1/images/generations")
+async def image_generations(request: Request):
+    body = await request.json()
+    STATS["image_generations"] += 1
+    await upstream_latency()
+    if random.random() < CONFIG["error_rate"]:
+        return JSONResponse({"error": "stub: injected failure"}, status_code=503)
+    image_id = f"{abs(hash(body.get('prompt', ''))) % 10**8}-{STATS['image_generations']}"
+    return {"data": [{"url": f"{str(request.base_url).rstrip('/')}/_stub/images/{image_id}.png"}]}
+
+
+@app.get("/_stub/images/{image_id}.png")
+async def image_download(image_id: str, request: Request):
+    """Streams in chunks and honours Range, like a CDN would"""
+    STATS["image_downloads"] += 1
+    data = image_bytes(image_id)
+    start = 0
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    range_header = request.headers.get("range", "")
+    if range_header.startswith("bytes=") and range_header.endswith("-"):
+        start = int(range_header[len("bytes="):-1])
+        if start >= len(data):
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{len(data)}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+
+    async def chunks():
+        for offset in range(start, len(data), 16 * 1024):
+            await asyncio.sleep(0)
+            yield data[offset:offset + 16 * 1024]
+
+    return StreamingResponse(chunks(), status_code=status, media_type="image/png", headers=headers)